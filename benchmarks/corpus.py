@@ -0,0 +1,165 @@
+# coding=utf-8
+
+import argparse
+import gzip
+import json
+import os
+import random
+
+genres = ["Hard Bop", "Bebop", "Cool Jazz", "Rock", "Pop", "Blues", "Classical", "Soul", "Funk", "Reggae",
+          "Electronic", "Folk", "Country", "Metal", "Punk", "Ambient", "Hip Hop", "Latin", "Opera", "Gospel"]
+codecs = [("CDDA", 16, 44100, None), ("FLAC", 24, 96000, None), ("FLAC", 16, 44100, None),
+          ("MP3", None, 44100, 320), ("MP3", None, 44100, 192), ("AAC", None, 48000, 256)]
+words = ["blue", "night", "train", "river", "song", "love", "moon", "walk", "fire", "rain", "city", "dream",
+         "groove", "time", "road", "light", "heart", "sky", "gold", "dance", "street", "garden", "shadow", "sun"]
+# non-ascii words exercise encoding, case insensitive like and the trigram tokenizer
+unicode_words = ["Café", "Björk", "Señor", "Ångström", "Übermensch", "Дорога", "東京", "Αθήνα", "naïve", "Zoë"]
+
+
+def make_name(rnd, unicode_ratio, count=2):
+    pool = unicode_words if rnd.random() < unicode_ratio else words
+    return " ".join(rnd.choice(pool).capitalize() for _ in range(count))
+
+
+def make_vocabulary(rnd, artists, albums, unicode_ratio):
+    return {
+        "artist": [make_name(rnd, unicode_ratio) for _ in range(artists)],
+        "album": [make_name(rnd, unicode_ratio, 3) for _ in range(albums)],
+        "composer": [make_name(rnd, unicode_ratio) for _ in range(max(1, artists // 4))]
+    }
+
+
+def make_song(rnd, vocab, album, track, unicode_ratio):
+    codec, bitdepth, samplerate, bitrate = rnd.choice(codecs)
+    artist = rnd.choice(vocab["artist"])
+    song = [
+        ("track", "%02d" % track),
+        ("title", make_name(rnd, unicode_ratio, rnd.randint(1, 4))),
+        ("length", str(rnd.randint(60, 1200))),
+        ("artist", artist),
+        ("albumartist", artist if rnd.random() < 0.8 else "Various Artists"),
+        ("album", album),
+        ("date", str(rnd.randint(1950, 2020))),
+        ("genre", rnd.choice(genres)),
+        ("codec", codec),
+        ("samplerate", str(samplerate)),
+        ("channels", "2"),
+        ("modified", "%d-%02d-%02d %02d:%02d:%02d" % (rnd.randint(2000, 2020), rnd.randint(1, 12), rnd.randint(1, 28),
+                                                     rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)))
+    ]
+
+    if bitdepth is not None:
+        song.append(("bitdepth", str(bitdepth)))
+
+    if bitrate is not None:
+        song.append(("bitrate", str(bitrate)))
+
+    if rnd.random() < 0.3:
+        song.append(("composer", rnd.choice(vocab["composer"])))
+
+    if rnd.random() < 0.1:
+        # values may contain the separator
+        song.append(("comment", "remastered: %d" % rnd.randint(1990, 2020)))
+
+    if rnd.random() < 0.05:
+        # empty values are stored as unset
+        song.append(("note", ""))
+
+    return song
+
+
+def write_file(path, songs, compress, bom, crlf):
+    newline = "\r\n" if crlf else "\n"
+    text = "".join("-" + newline + "".join("%s:%s%s" % (k, v, newline) for k, v in song) for song in songs)
+
+    if bom:
+        text = u"\ufeff" + text
+
+    if compress:
+        with gzip.open(path + ".txt.gz", "wt", encoding="utf8", newline="") as f:
+            f.write(text)
+    else:
+        with open(path + ".txt", "w", encoding="utf8", newline="") as f:
+            f.write(text)
+
+
+def generate_file(rnd, vocab, opts):
+    songcount = max(1, int(rnd.gauss(opts["songs"] / opts["files"], 3)))
+    songs = []
+
+    while songcount > 0:
+        n = min(songcount, rnd.randint(8, 20))
+        album = rnd.choice(vocab["album"])
+        songs.extend(make_song(rnd, vocab, album, i + 1, opts["unicode"]) for i in range(n))
+        songcount -= n
+
+    return songs
+
+
+def generate_corpus(datadir, songs=10000, files=100, gzip_ratio=0.5, artists=500, albums=1000, unicode_ratio=0.05,
+                    bom_ratio=0.1, crlf_ratio=0.1, seed=1):
+    rnd = random.Random(seed)
+    vocab = make_vocabulary(rnd, artists, albums, unicode_ratio)
+    opts = {"songs": songs, "files": files, "unicode": unicode_ratio}
+    paths = []
+
+    for i in range(files):
+        # spread files over a few levels of directories, like a real collection
+        directory = os.path.join(datadir, "disc%03d" % (i // 100), "%02d" % (i % 10))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "media%05d" % i)
+        write_file(path, generate_file(rnd, vocab, opts), rnd.random() < gzip_ratio, rnd.random() < bom_ratio,
+                   rnd.random() < crlf_ratio)
+        paths.append(path)
+
+    return {"datadir": datadir, "files": paths, "vocabulary": vocab, "seed": seed}
+
+
+def modify_corpus(corpus, ratio=0.05, seed=2):
+    rnd = random.Random(seed)
+    vocab = corpus["vocabulary"]
+    files = [x for x in corpus["files"] if os.path.exists(x + ".txt") or os.path.exists(x + ".txt.gz")]
+    changed = rnd.sample(files, max(1, int(len(files) * ratio)))
+
+    for path in changed:
+        compress = os.path.exists(path + ".txt.gz")
+        ext = ".txt.gz" if compress else ".txt"
+        opener = gzip.open if compress else open
+
+        with opener(path + ext, "rt", encoding="utf8") as f:
+            songs = [[tuple(line.split(":", 1)) for line in block.strip().splitlines()]
+                     for block in f.read().lstrip(u"\ufeff").split("-\n") if block.strip() != ""]
+
+        # retitle a few songs and add one, most songs keep their ids
+        for song in rnd.sample(songs, max(1, len(songs) // 5)):
+            song[1] = ("title", make_name(rnd, 0, 3))
+
+        songs.append(make_song(rnd, vocab, rnd.choice(vocab["album"]), len(songs) + 1, 0))
+        stat = os.stat(path + ext)
+        write_file(path, songs, compress, False, False)
+        # make sure the change is seen even on file systems with coarse timestamps
+        os.utime(path + ext, (stat.st_atime, stat.st_mtime + 2))
+
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic SongDB data directory")
+    parser.add_argument("datadir")
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--gzip", type=float, default=0.5, help="ratio of gzip compressed files")
+    parser.add_argument("--artists", type=int, default=500)
+    parser.add_argument("--albums", type=int, default=1000)
+    parser.add_argument("--unicode", type=float, default=0.05, help="ratio of non-ascii names")
+    parser.add_argument("--bom", type=float, default=0.1, help="ratio of files starting with a byte order mark")
+    parser.add_argument("--crlf", type=float, default=0.1, help="ratio of files with windows line endings")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    corpus = generate_corpus(args.datadir, args.songs, args.files, args.gzip, args.artists, args.albums, args.unicode,
+                             args.bom, args.crlf, args.seed)
+    print(json.dumps({"datadir": corpus["datadir"], "files": len(corpus["files"])}))
+
+
+if __name__ == '__main__':
+    main()
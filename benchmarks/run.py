@@ -0,0 +1,284 @@
+# coding=utf-8
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.corpus import generate_corpus, modify_corpus, genres
+from songdb import server
+
+
+def peak_rss():
+    # kilobytes on linux, bytes on macos
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {"self": own, "children": children}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summarize(name, durations, elapsed, items=None, errors=0):
+    result = {
+        "scenario": name,
+        "runs": len(durations),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(durations) / elapsed if elapsed > 0 else None,
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "p99": percentile(durations, 99),
+        "peak_rss": peak_rss()
+    }
+
+    if items is not None:
+        result["items"] = items
+        result["items_per_second"] = items / elapsed if elapsed > 0 else None
+
+    return result
+
+
+def configure(workdir, datadir, overrides):
+    server.close_db()
+    server.server_conf = {
+        "logfile": os.path.join(workdir, "songdb.log"),
+        "loglevel": "WARNING",
+        "datadir": datadir,
+        "encoding": "utf8",
+        "database": os.path.join(workdir, "songdb.db"),
+        "maxresult": 1000,
+        "username": "song",
+        "password": "db",
+        "require_auth": False,
+        "backend": "waitress",
+        "scandelay": 0
+    }
+    server.server_conf.update(overrides)
+    server.configure_logging()
+
+
+def reset_database():
+    server.close_db()
+    server.facet_counts.clear()
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(server.server_conf["database"] + suffix):
+            os.remove(server.server_conf["database"] + suffix)
+
+
+def count_songs():
+    with server.get_dbconn() as conn:
+        return conn.execute("select count(*) from song_f").fetchone()[0]
+
+
+def loaded_songs():
+    return server.metrics.gauges.get(("songdb_last_load_songs", ()), 0)
+
+
+def run_load(name, repeat, prepare):
+    durations = []
+    songs = 0
+    errors = 0
+    start = time.time()
+
+    for _ in range(repeat):
+        prepare()
+        server.metrics.set("songdb_last_load_songs", value=0)
+        t = time.time()
+        server.load_data()
+        durations.append(time.time() - t)
+        errors += 1 if server.data_error else 0
+        songs += loaded_songs()
+
+    return summarize(name, durations, time.time() - start, songs, errors)
+
+
+def bench_cold_load(repeat):
+    def prepare():
+        reset_database()
+        server.setup_db()
+
+    return run_load("cold_load", repeat, prepare)
+
+
+def bench_incremental_reload(corpus, repeat, ratio):
+    seeds = iter(range(100, 100 + repeat))
+    result = run_load("incremental_reload", repeat, lambda: modify_corpus(corpus, ratio, next(seeds)))
+    result["changed_ratio"] = ratio
+    return result
+
+
+def bench_noop_reload(repeat):
+    return run_load("noop_reload", repeat, lambda: None)
+
+
+def make_queries(corpus, count, seed):
+    rnd = random.Random(seed)
+    vocab = corpus["vocabulary"]
+    templates = [
+        lambda: {"filter": "@artist=%s" % rnd.choice(vocab["artist"])},
+        lambda: {"filter": "@artist:%s" % rnd.choice(vocab["artist"]).lower()},
+        lambda: {"filter": "@title~%s" % rnd.choice(vocab["album"]).split()[0][1:4]},
+        lambda: {"filter": "@genre:%s\n@samplerate>44100" % rnd.choice(genres)},
+        lambda: {"filter": "@album=%s\n@track<5" % rnd.choice(vocab["album"]).split()[1]},
+        lambda: {"filter": "@length>%d\n@length<%d" % (rnd.randint(60, 600), rnd.randint(600, 1200))},
+        lambda: {"filter": "@modified>2015-01-01 00:00:00\n@codec:FLAC", "limit": 100},
+        lambda: {"filter": "@genre:%s" % rnd.choice(genres), "limit": 50, "page": 3}
+    ]
+    return [rnd.choice(templates)() for _ in range(count)]
+
+
+def run_query(client, query):
+    query = dict(query)
+    pages = query.pop("page", 1)
+    response = client.post("/song", json=query)
+
+    # follow the cursor like the web interface does when scrolling
+    while response.status_code == 200 and pages > 1 and response.get_json()["next"] is not None:
+        query["after"] = response.get_json()["next"]
+        response = client.post("/song", json=query)
+        pages -= 1
+
+    if response.status_code == 200:
+        songs = response.get_json()["songs"]
+
+        if len(songs) > 0:
+            response = client.get("/song/%d" % songs[0]["id"])
+
+    return response.status_code == 200
+
+
+def bench_queries(name, queries, threads):
+    durations = []
+    errors = [0]
+    lock = threading.Lock()
+    chunks = [queries[i::threads] for i in range(threads)]
+
+    def worker(chunk):
+        client = server.app.test_client()
+        local = []
+        failed = 0
+
+        for query in chunk:
+            t = time.time()
+            failed += 0 if run_query(client, query) else 1
+            local.append(time.time() - t)
+
+        with lock:
+            durations.extend(local)
+            errors[0] += failed
+
+    start = time.time()
+    workers = [threading.Thread(target=worker, args=(x,)) for x in chunks]
+
+    for t in workers:
+        t.start()
+
+    for t in workers:
+        t.join()
+
+    result = summarize(name, durations, time.time() - start, errors=errors[0])
+    result["threads"] = threads
+    return result
+
+
+def bench_queries_during_reload(corpus, queries, threads, ratio):
+    done = threading.Event()
+
+    def reload():
+        seed = 1000
+
+        while not done.is_set():
+            modify_corpus(corpus, ratio, seed)
+            server.load_data()
+            seed += 1
+
+    loader = threading.Thread(target=reload)
+    loader.start()
+
+    try:
+        return bench_queries("queries_during_reload", queries, threads)
+    finally:
+        done.set()
+        loader.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run SongDB load and query benchmarks")
+    parser.add_argument("--songs", type=int, default=20000)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--gzip", type=float, default=0.5, help="ratio of gzip compressed files")
+    parser.add_argument("--artists", type=int, default=1000)
+    parser.add_argument("--albums", type=int, default=2000)
+    parser.add_argument("--unicode", type=float, default=0.05, help="ratio of non-ascii names")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each load scenario")
+    parser.add_argument("--queries", type=int, default=2000, help="queries per query scenario")
+    parser.add_argument("--threads", type=int, default=8, help="threads of the concurrent query scenarios")
+    parser.add_argument("--changed", type=float, default=0.05, help="ratio of files changed per reload")
+    parser.add_argument("--config", help="json file with server options, e.g. loadworkers or poolsize")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the generated data directory")
+    args = parser.parse_args()
+
+    overrides = {}
+
+    if args.config is not None:
+        with open(args.config) as f:
+            overrides = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix="songdb-bench-")
+
+    try:
+        datadir = os.path.join(workdir, "data")
+        t = time.time()
+        corpus = generate_corpus(datadir, args.songs, args.files, args.gzip, args.artists, args.albums, args.unicode,
+                                 seed=args.seed)
+        generated = time.time() - t
+        configure(workdir, datadir, overrides)
+        queries = make_queries(corpus, args.queries, args.seed)
+        results = [bench_cold_load(args.repeat), bench_noop_reload(args.repeat),
+                   bench_incremental_reload(corpus, args.repeat, args.changed),
+                   bench_queries("queries", queries, 1),
+                   bench_queries("queries_concurrent", queries, args.threads),
+                   bench_queries_during_reload(corpus, queries, args.threads, args.changed)]
+        report = {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)),
+            "python": platform.python_version(),
+            "sqlite": server.sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "corpus": {"songs": count_songs(), "files": args.files, "gzip": args.gzip, "artists": args.artists,
+                       "albums": args.albums, "unicode": args.unicode, "seed": args.seed, "generated": generated},
+            "config": overrides,
+            "results": results
+        }
+        server.close_db()
+    finally:
+        if args.keep:
+            print("data kept in %s" % workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
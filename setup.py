@@ -7,12 +7,15 @@ setup(
     version="0.7",
     description="SongDB indexes your music collection",
     author="Tommy Hellstrom",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     include_package_data=True,
     install_requires=[
         "Flask",
         "waitress"
     ],
+    extras_require={
+        "numpy": ["numpy"]
+    },
     entry_points={
         "console_scripts": [
             "songdb_server=songdb.server:main"
@@ -25,21 +25,41 @@ SOFTWARE.
 """
 
 from functools import wraps
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque, OrderedDict, Counter
+from itertools import chain, islice
 from datetime import datetime
 import os
+import base64
+import bisect
+import heapq
 import fnmatch
 import logging
 import logging.config
 import sqlite3
-import codecs
-import tempfile
 import gzip
 import json
+import hashlib
 import sys
 import time
 import threading
+import ctypes
+import ctypes.util
+import select
+import struct
+import re
+import multiprocessing
+import signal
+import socket
+import urllib.request
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 app = Flask(__name__, static_url_path='/static')
 app.config["JSONIFY_PRETTYPRINT_REGULAR"] = False
@@ -47,6 +67,34 @@ app.config["JSON_AS_ASCII"] = False
 
 server_conf = None
 data_error = False
+data_generation = 0
+writer_conn = None
+writer_lock = threading.RLock()
+rebuild_lock = threading.Lock()
+dimension_counts = {}
+facet_counts = {}
+facet_lock = threading.Lock()
+process_role = "single"
+shared_state = None
+shared_fields = ["generation", "ready", "error", "running", "started", "files", "total", "songs"]
+rebuild_event = None
+generation_lock = threading.Lock()
+cancelled_queries = Counter()
+compiled_filters = OrderedDict()
+compiled_filters_lock = threading.Lock()
+slow_queries = deque()
+slow_query_stats = OrderedDict()
+slow_query_lock = threading.Lock()
+suggest_index = {}
+suggest_lock = threading.Lock()
+load_progress = {"running": False, "started": None, "files": 0, "total": 0, "songs": 0}
+data_ready = threading.Event()
+columnar_index = None
+columnar_lock = threading.Lock()
+parse_executor = None
+parse_executor_workers = 0
+parse_executor_lock = threading.Lock()
+maintenance_stats = {"lastrun": None, "orphans": 0, "reclaimed": 0}
 
 
 class NotFoundError(Exception):
@@ -57,6 +105,10 @@ class ValidationError(Exception):
     pass
 
 
+class QueryCancelledError(Exception):
+    pass
+
+
 def expand_keywords(kw):
     kw_list = []
 
@@ -138,10 +190,22 @@ keywords = [
 ]
 
 keywords_dbkeys = [x[0] for x in keywords]
+search_fields = [
+    "id", "media", "album", "artist", "title", "comment", "bitrate",
+    "bitdepth", "samplerate", "channels", "length", "codec"
+]
 keywords_db = keywords
 ekeywords = expand_keywords(keywords)
 keywords_lookup = {k[0]: k for k in keywords}
 ekeywords_lookup = {k[0]: k for k in ekeywords}
+filter_tokens = {k[0]: {op: ekeywords_lookup[k[0] + op] for op in k[1]} for k in keywords}
+schema_migrations = [
+    ["create index song_f_file_id_idx on song_f(file_id)"],
+    ["alter table song_f add column fingerprint text"],
+    ["alter table song_f add column position integer"]
+]
+song_columns = ["%s_id" % k for k in keywords_dbkeys + ["file"]] + ["fingerprint", "position"]
+fulltext_keys = ["title", "artist", "albumartist", "album", "composer", "performer", "genre", "comment", "note", "path"]
 
 
 def find_files(directory, patterns):
@@ -153,6 +217,16 @@ def find_files(directory, patterns):
                     yield filename
 
 
+def find_path_files(paths, patterns):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from find_files(path, patterns)
+        elif os.path.isfile(path):
+            for pattern in patterns:
+                if fnmatch.fnmatch(os.path.basename(path), pattern):
+                    yield path
+
+
 def load_config():
     with open(sys.argv[1]) as f:
         global server_conf
@@ -208,27 +282,277 @@ def configure_logging():
     })
 
 
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+load_buckets = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.histograms = OrderedDict()
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value, buckets=latency_buckets):
+        i = bisect.bisect_left(buckets, value)
+
+        with self.lock:
+            key = (name, labels)
+            hist = self.histograms.get(key)
+
+            if hist is None:
+                hist = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+
+            hist[1][i] += 1
+            hist[2] += value
+
+    def render(self, extra=()):
+        with self.lock:
+            samples = {}
+
+            for (name, labels), value in chain(self.counters.items(), self.gauges.items(), extra):
+                samples.setdefault(name, []).append((name, labels, value))
+
+            for (name, labels), (buckets, counts, total) in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+
+                for le, n in zip(buckets + ["+Inf"], counts):
+                    cumulative += n
+                    lines.append((name + "_bucket", labels + (("le", str(le)),), cumulative))
+
+                lines.append((name + "_sum", labels, total))
+                lines.append((name + "_count", labels, cumulative))
+
+        out = []
+
+        for name in sorted(samples.keys()):
+            if name in self.help:
+                out.append("# HELP %s %s" % (name, self.help[name][1]))
+                out.append("# TYPE %s %s" % (name, self.help[name][0]))
+
+            for sample, labels, value in samples[name]:
+                if len(labels) > 0:
+                    sample += "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                                                               .replace("\n", "\\n")) for k, v in labels)
+
+                out.append("%s %s" % (sample, repr(float(value)) if isinstance(value, float) else value))
+
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("songdb_http_request_duration_seconds", "histogram", "HTTP request latency by route.")
+metrics.describe("songdb_sql_duration_seconds", "histogram", "SQL execution time by query.")
+metrics.describe("songdb_sql_rows_total", "counter", "Rows returned by query.")
+metrics.describe("songdb_query_cancelled_total", "counter", "Queries cancelled by the time or step budget.")
+metrics.describe("songdb_columnar_duration_seconds", "histogram", "Search time in the columnar index.")
+metrics.describe("songdb_load_duration_seconds", "histogram", "Duration of data loads.")
+metrics.describe("songdb_load_files_total", "counter", "Data files loaded or removed.")
+metrics.describe("songdb_load_songs_total", "counter", "Songs loaded.")
+metrics.describe("songdb_last_load_files", "gauge", "Data files loaded or removed by the last load.")
+metrics.describe("songdb_last_load_songs", "gauge", "Songs loaded by the last load.")
+metrics.describe("songdb_data_error", "gauge", "1 if the last load failed.")
+metrics.describe("songdb_data_generation", "gauge", "Number of data changes since start.")
+metrics.describe("songdb_cache_hits_total", "counter", "Result cache hits.")
+metrics.describe("songdb_cache_misses_total", "counter", "Result cache misses.")
+
+
+class ConnectionPool(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.idle = []
+        self.inuse = 0
+        self.created = 0
+        self.acquired = 0
+        self.waited = 0
+        self.draining = False
+
+    def full(self):
+        return self.draining or (len(self.idle) == 0 and self.inuse >= server_conf.get("poolsize", 8))
+
+    def acquire(self):
+        with self.cond:
+            if self.full():
+                self.waited += 1
+
+                while self.full():
+                    self.cond.wait()
+
+            self.inuse += 1
+            self.acquired += 1
+
+            if len(self.idle) > 0:
+                return self.idle.pop()
+
+        try:
+            conn = connect_db(readonly=True)
+        except Exception:
+            with self.cond:
+                self.inuse -= 1
+                self.cond.notify_all()
+            raise
+
+        with self.cond:
+            self.created += 1
+
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+
+        with self.cond:
+            self.inuse -= 1
+            self.idle.append(conn)
+            self.cond.notify_all()
+
+    def drain(self):
+        with self.cond:
+            self.draining = True
+
+            while self.inuse > 0:
+                self.cond.wait()
+
+            for conn in self.idle:
+                conn.close()
+
+            self.idle = []
+
+    def resume(self):
+        with self.cond:
+            self.draining = False
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+
+            self.idle = []
+
+    def info(self):
+        with self.cond:
+            return {
+                "size": server_conf.get("poolsize", 8),
+                "idle": len(self.idle),
+                "inuse": self.inuse,
+                "created": self.created,
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "draining": self.draining
+            }
+
+
+def connect_db(readonly=False, database=None):
+    # queries are built from the filter shape only, so pooled connections reuse their prepared statements
+    statements = server_conf.get("statementcache", 256)
+
+    if readonly and process_role == "worker":
+        # workers never write, the owner process keeps the database in wal mode
+        uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(database or server_conf["database"]))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=statements)
+    else:
+        conn = sqlite3.connect(database or server_conf["database"], check_same_thread=False,
+                               cached_statements=statements)
+
+    if not readonly:
+        # must come before anything is written to a new database
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+    if process_role != "worker":
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA case_sensitive_like=OFF")
+
+    for pragma, key in (("cache_size", "cachesize"), ("mmap_size", "mmapsize"), ("temp_store", "tempstore")):
+        if key in server_conf:
+            conn.execute("PRAGMA %s=%s" % (pragma, server_conf[key]))
+
+    if readonly:
+        conn.execute("PRAGMA query_only=ON")
+
+    return conn
+
+
 @contextmanager
 def get_dbconn():
-    conn = None
+    conn = dbpool.acquire()
     try:
-        conn = sqlite3.connect(server_conf["database"])
-        conn.execute("PRAGMA journal_mode=WAL")
-        conn.execute("PRAGMA synchronous=NORMAL")
-        conn.execute("PRAGMA case_sensitive_like=OFF")
         yield conn
     finally:
-        if conn is not None:
+        dbpool.release(conn)
+
+
+@contextmanager
+def get_writer_dbconn(database=None):
+    global writer_conn
+
+    if database is not None:
+        # a database that is not live, e.g. a shadow database being built
+        conn = connect_db(database=database)
+        try:
+            yield conn
+        finally:
             conn.close()
+        return
+
+    with writer_lock:
+        if writer_conn is None:
+            writer_conn = connect_db()
+
+        try:
+            yield writer_conn
+        finally:
+            if writer_conn.in_transaction:
+                writer_conn.rollback()
+
+
+def get_dbsize():
+    size = os.path.getsize(server_conf["database"])
+    wal = server_conf["database"] + "-wal"
+
+    if os.path.exists(wal):
+        size += os.path.getsize(wal)
+
+    return size
 
 
-def setup_db():
-    logging.getLogger(__name__).info("setup database: %s", server_conf["database"])
-    if os.path.exists(server_conf["database"]):
+def close_db():
+    global writer_conn
+
+    dbpool.close()
+
+    with writer_lock:
+        if writer_conn is not None:
+            writer_conn.close()
+            writer_conn = None
+
+
+dbpool = ConnectionPool()
+
+
+def setup_db(database=None):
+    logging.getLogger(__name__).info("setup database: %s", database or server_conf["database"])
+    if os.path.exists(database or server_conf["database"]):
         logging.getLogger(__name__).info("database already exist, skipping setup")
+        migrate_db(database)
         return
 
-    with get_dbconn() as conn:
+    with get_writer_dbconn(database) as conn:
         with conn:
             c = conn.cursor()
 
@@ -267,399 +591,2268 @@ def setup_db():
             logging.getLogger(__name__).debug(sql)
             c.execute(sql)
 
+    migrate_db(database)
+
 
-def load_data():
-    global data_error
+def migrate_db(database=None):
+    with get_writer_dbconn(database) as conn:
+        with conn:
+            c = conn.cursor()
+            c.execute("begin")
+            c.execute("pragma user_version")
+            version = c.fetchone()[0]
+
+            for v, statements in enumerate(schema_migrations[version:], version + 1):
+                logging.getLogger(__name__).info("migrating database to schema version %d", v)
+
+                for sql in statements:
+                    logging.getLogger(__name__).debug(sql)
+                    c.execute(sql)
+
+                c.execute("pragma user_version = %d" % v)
+
+            setup_indexes(c)
+            setup_fulltext(c)
+
+
+def setup_indexes(c):
+    wanted = set(server_conf.get("indexes", []))
+
+    for k in wanted.difference(keywords_dbkeys):
+        raise Exception(f"invalid index key: {k}")
+
+    c.execute("select name from sqlite_master where type = 'index' and tbl_name = 'song_f' and name like 'song_f_%_id_idx'")
+    existing = {x[0] for x in c}
+
+    for k in keywords_dbkeys:
+        name = "song_f_%s_id_idx" % k
+
+        if k in wanted and name not in existing:
+            logging.getLogger(__name__).info("creating index: %s", name)
+            c.execute("create index %s on song_f(%s_id)" % (name, k))
+        elif k not in wanted and name in existing:
+            logging.getLogger(__name__).info("dropping index: %s", name)
+            c.execute("drop index %s" % name)
+
+
+def setup_fulltext(c):
+    c.execute("select count(*) from sqlite_master where type = 'table' and name = 'song_fts'")
+    fts_exists = c.fetchone()[0] > 0
+
+    if fulltext_enabled() and not fts_exists:
+        logging.getLogger(__name__).info("creating full-text index")
+        sql = """
+            create virtual table song_fts using fts5(%s, tokenize = 'trigram')
+        """ % ", ".join(fulltext_keys)
+        logging.getLogger(__name__).debug(sql)
+        c.execute(sql)
+
+        sql = """
+            insert into song_fts (rowid, %s) select id, %s from v_song
+        """ % (", ".join(fulltext_keys), ", ".join(fulltext_keys))
+        logging.getLogger(__name__).debug(sql)
+        c.execute(sql)
+    elif not fulltext_enabled() and fts_exists:
+        logging.getLogger(__name__).info("dropping full-text index")
+        c.execute("drop table song_fts")
+
+
+def fulltext_enabled():
+    return server_conf.get("fulltext", False)
+
+
+def load_data(paths=None):
+    global data_error, data_generation
+
+    facetdeltas = {k: Counter() for k in get_facet_keys()}
+    starttime = time.time()
+    result = "error"
+    update_load_progress(running=True, started=starttime, files=0, total=0, songs=0)
 
     try:
-        load_data_internal()
+        if server_conf.get("reloadmode", "inplace") == "shadow":
+            changes = shadow_load_data(paths, facetdeltas=facetdeltas)
+        else:
+            changes = load_data_internal(paths, facetdeltas=facetdeltas)
+
+        if changes > 0:
+            data_generation += 1
+
+        if changes > 0 or len(facet_counts) == 0:
+            refresh_facets(facetdeltas)
+
         data_error = False
+        result = "ok" if changes > 0 else "unchanged"
     except Exception:
+        # a failed load may have committed some files already
+        data_generation += 1
+        facet_counts.clear()
         data_error = True
         logging.getLogger(__name__).exception("Error loading data")
+    finally:
+        load_progress["running"] = False
+        metrics.observe("songdb_load_duration_seconds", (("result", result),), time.time() - starttime, load_buckets)
 
+    refresh_columnar_index()
+    refresh_suggestions()
 
-def load_data_internal():
-    warncount = 0
-    songcount = 0
-    logging.getLogger(__name__).info("loading data: %s", server_conf["datadir"])
-    with get_dbconn() as conn:
-        c = conn.cursor()
-        c.execute("select id, value, mtime from file_d")
-        current = {v: (i, m) for i, v, m in c}
-        loaded = set()
+    # ready once the database has been reconciled with the whole datadir
+    if paths is None and not data_error:
+        data_ready.set()
 
-        for f in find_files(server_conf["datadir"], ("*.txt", "*.txt.gz")):
-            media = os.path.splitext(os.path.basename(f))[0]
-            fpath = os.path.relpath(os.path.normpath(f), os.path.normpath(server_conf["datadir"]))
-            fmtime = os.path.getmtime(f)
-            loaded.add(fpath)
+    publish_state()
 
-            with conn:
-                if fpath in current:
-                    if abs(fmtime - current[fpath][1]) <= sys.float_info.epsilon:  # equals fp
-                        continue
-                    else:
-                        c.execute("delete from song_f where file_id = ?", (current[fpath][0],))
 
-                sql = """
-                   insert or replace into file_d (value, mtime) values (?, ?)
-                """
+def update_load_progress(**kwargs):
+    load_progress.update(kwargs)
+    publish_state()
 
-                logging.getLogger(__name__).debug(sql)
-                c.execute(sql, (fpath, fmtime))
 
-                org_file = f
-                extracted = False
+def publish_state():
+    # the owner process tells the workers about data changes and load progress
+    if shared_state is None or process_role != "owner":
+        return
 
-                if f.endswith(".txt.gz"):
-                    media = os.path.splitext(media)[0]
-                    extracted = True
-                    logging.getLogger(__name__).debug("extracting file: %s", f)
-                    gziptmp = tempfile.mkstemp()
+    state = dict(load_progress, generation=data_generation, ready=data_ready.is_set(), error=data_error)
+    state["started"] = state["started"] or 0
 
-                    with gzip.open(f, "rb") as gzipf:
-                        with os.fdopen(gziptmp[0], "wb") as plainf:
-                            plainf.writelines(gzipf)
+    with shared_state.get_lock():
+        for i, k in enumerate(shared_fields):
+            shared_state[i] = float(state[k])
 
-                    f = gziptmp[1]
 
-                enc = server_conf["encoding"]
-                logging.getLogger(__name__).info("loading file: %s, %s", org_file, enc)
+def sync_shared_state():
+    global data_error, data_generation
 
-                with codecs.open(f, "r", enc) as ff:
-                    lines = [x.strip().strip(u"\ufeff").strip() for x in ff.readlines()]
-                    lines.append("-")
+    with shared_state.get_lock():
+        state = dict(zip(shared_fields, shared_state[:]))
 
-                if extracted:
-                    logging.getLogger(__name__).debug("removing file: %s", f)
-                    os.unlink(f)
+    data_error = state["error"] != 0
+    load_progress.update(running=state["running"] != 0, started=state["started"], files=int(state["files"]),
+                         total=int(state["total"]), songs=int(state["songs"]))
 
-                data = {}
+    if state["ready"] != 0:
+        data_ready.set()
+    else:
+        data_ready.clear()
 
-                for x in [x.split(":", 1) for x in lines]:
-                    if x[0] == "":
-                        continue
-                    if x[0] == '-':
-                        if len(data) > 0:
-                            val_list = []
-
-                            for k in keywords_dbkeys:
-                                if k == "media":
-                                    val = media
-                                    val_list.append(val)
-                                else:
-                                    val = data[k] if k in data else None
-
-                                    if val is None or val.strip() == "":
-                                        val = keywords_lookup[k][7]
-                                    else:
-                                        val = keywords_lookup[k][4](val)
-
-                                    val_list.append(val)
-
-                                sql = """
-                                   insert or ignore into %s_d (value) values (?)
-                                """ % k
-                                logging.getLogger(__name__).debug(sql)
-                                logging.getLogger(__name__).debug(val)
-                                c.execute(sql, [val])
-
-                            sql = """
-                               insert into song_f (%s) select %s from %s where %s
-                            """ % (", ".join(["%s_id" % a for a in keywords_dbkeys + ["file"]]),
-                                   ", ".join(["%s_d.id" % a for a in keywords_dbkeys + ["file"]]),
-                                   ", ".join(["%s_d" % a for a in keywords_dbkeys + ["file"]]),
-                                   " and ".join(["%s_d.value = ?" % a for a in keywords_dbkeys + ["file"]]))
-                            logging.getLogger(__name__).debug(sql)
-                            logging.getLogger(__name__).debug(val_list)
-                            c.execute(sql, val_list + [fpath])
-                            songcount += 1
-
-                        data = {}
-
-                    elif x[0] not in keywords_dbkeys:
-                        logging.getLogger(__name__).warning("unknown key in file (%s): %s", org_file, x)
-                        warncount += 1
-                    else:
-                        data[x[0]] = x[1]
+    generation = int(state["generation"])
 
-        for x in set(current.keys()).difference(loaded):
-            logging.getLogger(__name__).info("Removing from index: %s", x)
-            with conn:
-                c.execute("delete from song_f where file_id = ?", (current[x][0],))
-                c.execute("delete from file_d where id = ?", (current[x][0],))
+    if generation == data_generation:
+        return
 
-        c.execute("select count(*) from v_song")
-        loadedcount = c.fetchone()[0]
-        logging.getLogger(__name__).info(
-            "Indexing %d songs. Loaded %d songs with %d warnings", loadedcount, songcount, warncount)
+    with generation_lock:
+        if generation == data_generation:
+            return
 
-        if warncount > 0:
-            logging.getLogger(__name__).warning("songs loaded with %d warnings", warncount)
+        # a shadow reload replaces the database file, connections to the old one must go
+        dbpool.drain()
+        dbpool.resume()
+        dimension_counts.clear()
+        facet_counts.clear()
+        data_generation = generation
 
+    if columnar_enabled():
+        threading.Thread(target=refresh_columnar_index, daemon=True).start()
 
-def fetch_song(songid):
-    fields = [x for x in keywords_dbkeys]
-    fields.append("id")
+    threading.Thread(target=refresh_suggestions, daemon=True).start()
 
-    sql = "select %s from v_song where " % ", ".join(fields) + "id = ?"
-    logging.getLogger(__name__).debug(sql)
-    logging.getLogger(__name__).debug(songid)
-    with get_dbconn() as conn:
+
+def shadow_load_data(paths=None, rebuild=False, facetdeltas=None):
+    shadow = server_conf["database"] + ".shadow"
+
+    # holding the writer lock keeps other loads from writing to the live database meanwhile
+    with writer_lock:
+        if not rebuild:
+            with get_dbconn() as conn:
+                current, removed_files, changed = scan_data_files(conn.cursor(), paths)
+
+            if len(changed) + len(removed_files) == 0:
+                return 0
+
+        remove_database(shadow)
+
+        try:
+            if rebuild:
+                logging.getLogger(__name__).info("rebuilding database: %s", shadow)
+                setup_db(shadow)
+            else:
+                logging.getLogger(__name__).info("copying database: %s", shadow)
+
+                with get_writer_dbconn() as conn:
+                    dest = sqlite3.connect(shadow)
+                    conn.backup(dest)
+                    dest.close()
+
+            changes = load_data_internal(paths, shadow, facetdeltas)
+            check_database(shadow)
+            swap_database(shadow)
+            return changes
+        finally:
+            remove_database(shadow)
+
+
+def check_database(database):
+    with get_writer_dbconn(database) as conn:
         c = conn.cursor()
-        c.execute(sql, (songid,))
-        row = c.fetchone()
+        c.execute("pragma integrity_check")
+        result = [x[0] for x in c]
 
-        if row is None:
-            return None
+        if result != ["ok"]:
+            raise Exception("integrity check failed: %s: %s" % (database, "; ".join(result)))
 
-        result = {k: keywords_lookup[k][5](v) if k in keywords_lookup else v 
-                  for k, v in zip(fields, row) if k == "id" or v != keywords_lookup[k][7]}
-        return result
+        c.execute("analyze")
+        # leave a single self-contained file that can be renamed
+        c.execute("pragma journal_mode=DELETE")
 
 
-def find_songs(afilter):
-    criterias = []
-    filters = afilter.strip().split("\n")
+def swap_database(shadow):
+    global writer_conn
 
-    for f in [x.strip() for x in filters]:
-        if len(f) == 0:
-            continue
+    logging.getLogger(__name__).info("swapping in database: %s", shadow)
 
-        if not f.startswith("@"):
-            raise ValidationError("filter must start with @: %s" % f)
+    with writer_lock:
+        # wait for in-flight queries to finish, new ones wait for the swap
+        dbpool.drain()
 
-        f = f[1:]
-        found = False
+        try:
+            if writer_conn is not None:
+                writer_conn.close()
+                writer_conn = None
 
-        for k in ekeywords:
-            if f.startswith(k[0]):
-                found = True
-                searchstr = f[len(k[0]):].strip()
+            # with every connection closed the old database has no pending wal content
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(server_conf["database"] + suffix):
+                    os.unlink(server_conf["database"] + suffix)
 
-                if len(searchstr) > 0:
-                    criterias.append((k[0][0:-1], k[0][-1:], searchstr))
+            os.replace(shadow, server_conf["database"])
+        finally:
+            dbpool.resume()
 
-                break
 
-        if not found:
-            raise ValidationError("unknown filter: %s" % f)
+def remove_database(database):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(database + suffix):
+            os.unlink(database + suffix)
 
-    if len(criterias) == 0:
-        return []
 
-    where, values = build_where(set(criterias))
+def rebuild_database():
+    global data_generation
 
-    fields = [
-        "id", "media", "album", "artist", "title", "comment", "bitrate", 
-        "bitdepth", "samplerate", "channels", "length", "codec"
-    ]
-    sql = "select %s from v_song where " % ", ".join(fields) + where + " limit " + str(server_conf["maxresult"])
-    logging.getLogger(__name__).debug(sql)
-    logging.getLogger(__name__).debug(values)
-    with get_dbconn() as conn:
-        c = conn.cursor()
+    starttime = time.time()
+    result = "error"
+    update_load_progress(running=True, started=starttime, files=0, total=0, songs=0)
 
-        result = []
+    try:
+        shadow_load_data(rebuild=True)
+        data_generation += 1
+        facet_counts.clear()
+        refresh_facets()
+        refresh_columnar_index()
+        refresh_suggestions()
+        result = "rebuild"
+    except Exception:
+        logging.getLogger(__name__).exception("Error rebuilding database")
+    finally:
+        load_progress["running"] = False
+        metrics.observe("songdb_load_duration_seconds", (("result", result),), time.time() - starttime, load_buckets)
+        publish_state()
+        rebuild_lock.release()
+
+
+class DimensionCache(object):
+    def __init__(self, c):
+        self.ids = {}
+        self.stored = {}
+        self.nextids = {}
+        self.pending = {}
+
+        # only the values used by loaded songs are read, see prefetch
+        for k in keywords_dbkeys:
+            c.execute("select coalesce(max(id), 0) from %s_d" % k)
+            self.ids[k] = {}
+            self.stored[k] = c.fetchone()[0]
+            self.nextids[k] = self.stored[k] + 1
+            self.pending[k] = []
+
+    def prefetch(self, c, val_lists):
+        for i, k in enumerate(keywords_dbkeys):
+            if self.stored[k] == 0:
+                continue
+
+            ids = self.ids[k]
+            missing = list({x[i] for x in val_lists}.difference(ids.keys()))
+
+            for j in range(0, len(missing), 500):
+                chunk = missing[j:j + 500]
+                c.execute("select id, value from %s_d where value in (%s)" % (k, ", ".join(["?"] * len(chunk))), chunk)
+                ids.update((v, dimid) for dimid, v in c)
+
+    def lookup(self, k, val):
+        ids = self.ids[k]
+        dimid = ids.get(val)
+
+        if dimid is None:
+            dimid = self.nextids[k]
+            self.nextids[k] += 1
+            ids[val] = dimid
+            self.pending[k].append((dimid, val))
+
+        return dimid
+
+    def flush(self, c):
+        for k in keywords_dbkeys:
+            if len(self.pending[k]) > 0:
+                sql = "insert into %s_d (id, value) values (?, ?)" % k
+                logging.getLogger(__name__).debug(sql)
+                c.executemany(sql, self.pending[k])
+                self.pending[k] = []
 
-        for res in c.execute(sql, values):
-            result.append({k: keywords_lookup[k][5](v) if k in keywords_lookup else v 
-                           for k, v in zip(fields, res) if k == "id" or v != keywords_lookup[k][7]})
-        return result
 
+def song_fingerprint(val_list, occurrences):
+    digest = hashlib.sha1("\x1f".join([str(v) for v in val_list]).encode("utf-8")).hexdigest()
+    # identical songs in a file are told apart by their order
+    occurrence = occurrences.get(digest, 0)
+    occurrences[digest] = occurrence + 1
+    return "%s:%d" % (digest, occurrence)
 
-def build_where(conds):
-    condgroups = {}
 
-    for c in conds:
-        li = condgroups.get(c[0], [])
-        li.append(c)
-        condgroups[c[0]] = li
+def flush_songs(c, dimcache, songs, ftsrows, updates=None, ftsupdates=None):
+    dimcache.flush(c)
 
-    allgroups = []
-    values = []
+    if len(songs) > 0:
+        sql = "insert into song_f (id, %s) values (?, %s)" % (", ".join(song_columns), ", ".join(["?"] * len(song_columns)))
+        logging.getLogger(__name__).debug(sql)
+        c.executemany(sql, songs)
+        del songs[:]
 
-    for k in condgroups.keys():
-        groups = []
+    if updates is not None and len(updates) > 0:
+        sql = "update song_f set %s where id = ?" % ", ".join(["%s = ?" % a for a in song_columns])
+        logging.getLogger(__name__).debug(sql)
+        c.executemany(sql, updates)
+        del updates[:]
 
-        for c in condgroups[k]:
-            lookup = ekeywords_lookup[c[0] + c[1]]
-            groups.append(k + " " + lookup[1] + " ?")
-            values.append(lookup[2](c[2]))
+    if len(ftsrows) > 0:
+        sql = "insert into song_fts (rowid, %s) values (?, %s)" % (", ".join(fulltext_keys),
+                                                                  ", ".join(["?"] * len(fulltext_keys)))
+        logging.getLogger(__name__).debug(sql)
+        c.executemany(sql, ftsrows)
+        del ftsrows[:]
 
-        expr = " and ".join(groups)
-        allgroups.append("((" + expr + ") and %s != ?)" % k)
-        values.append(keywords_lookup[k][7])
+    if ftsupdates is not None and len(ftsupdates) > 0:
+        sql = "update song_fts set %s where rowid = ?" % ", ".join(["%s = ?" % a for a in fulltext_keys])
+        logging.getLogger(__name__).debug(sql)
+        c.executemany(sql, ftsupdates)
+        del ftsupdates[:]
 
-    return " and ".join(allgroups), values
 
+def fulltext_values(val_list):
+    return [val_list[keywords_dbkeys.index(k)] for k in fulltext_keys]
 
-def valid_auth(username, password):
-    return username == server_conf["username"] and password == server_conf["password"]
 
+def subtract_facet_values(c, facetdeltas, songids):
+    keys = list(facetdeltas.keys())
 
-def requires_auth(f):
-    # basic auth
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        auth = request.authorization
+    if len(keys) == 0:
+        return
 
-        if not server_conf["require_auth"]:
-            return f(*args, **kwargs)
-        elif not auth or not valid_auth(auth.username, auth.password):
-            return Response(
-                'Could not verify your access level for that URL.\n'
-                'You have to login with proper credentials', 401,
-                {'WWW-Authenticate': 'Basic realm="Login Required"'})
-        else:
-            return f(*args, **kwargs)
+    for i in range(0, len(songids), 500):
+        chunk = songids[i:i + 500]
+        sql = build_select(keys) + "\nwhere song_f.id in (%s)" % ", ".join(["?"] * len(chunk))
 
-    return decorated
+        for row in c.execute(sql, chunk):
+            for k, v in zip(keys, row):
+                facetdeltas[k][v] -= 1
 
 
-@app.route('/song', methods=['POST'])
-@requires_auth
-def do_search():
-    logging.getLogger(__name__).debug("search")
-    jsondata = request.get_json()
+def delete_songs(c, songids):
+    if fulltext_enabled():
+        c.executemany("delete from song_fts where rowid = ?", [(x,) for x in songids])
 
-    if "filter" not in jsondata:
-        raise ValidationError("filter is missing")
+    c.executemany("delete from song_f where id = ?", [(x,) for x in songids])
 
-    if jsondata["filter"] is None or jsondata["filter"].strip() == "":
-        return jsonify({"songs": []})
 
-    logging.getLogger(__name__).debug(jsondata["filter"])
-    result = find_songs(jsondata["filter"])
-    return jsonify({"songs": result})
+def delete_file_songs(c, fileid):
+    if fulltext_enabled():
+        c.execute("delete from song_fts where rowid in (select id from song_f where file_id = ?)", (fileid,))
 
+    c.execute("delete from song_f where file_id = ?", (fileid,))
 
-@app.route('/song/<int:songid>', methods=['GET'])
-@requires_auth
-def get_song(songid):
-    logging.getLogger(__name__).debug("get song: %d", songid)
-    song = fetch_song(songid)
 
-    if song is None:
-        raise NotFoundError("song with id %d does not exist" % songid)
+def read_songs(f, enc, warnings):
+    media = os.path.splitext(os.path.basename(f))[0]
 
-    return jsonify(song)
+    if f.endswith(".txt.gz"):
+        media = os.path.splitext(media)[0]
+        ff = gzip.open(f, "rt", encoding=enc)
+    else:
+        ff = open(f, "r", encoding=enc)
 
+    with ff:
+        data = {}
 
-@app.route('/song/<int:songid>/<string:attribute>', methods=['GET'])
-@requires_auth
-def get_song_attr(songid, attribute):
-    logging.getLogger(__name__).debug("get song attribute: %d, %s", songid, attribute)
-    song = fetch_song(songid)
+        for line in chain(ff, ["-"]):
+            x = line.strip().strip(u"\ufeff").strip().split(":", 1)
 
-    if song is None:
-        raise NotFoundError("song with id %d does not exist" % songid)
+            if x[0] == "":
+                continue
+            if x[0] == '-':
+                if len(data) > 0:
+                    val_list = []
 
-    if attribute not in song:
-        raise NotFoundError("attribute %s not found on song: %d" % (attribute, songid))
+                    for k in keywords_dbkeys:
+                        if k == "media":
+                            val = media
+                        else:
+                            val = data[k] if k in data else None
 
-    return jsonify({attribute: song[attribute], "id": song["id"]})
+                            if val is None or val.strip() == "":
+                                val = keywords_lookup[k][7]
+                            else:
+                                val = keywords_lookup[k][4](val)
 
+                        val_list.append(val)
 
-@app.route('/admin/info', methods=['GET'])
-@requires_auth
-def get_info():
-    logging.getLogger(__name__).debug("info")
-    with get_dbconn() as conn:
-        c = conn.cursor()
-        c.execute("select count(*) from v_song")
-        result = {
-            "loaded": c.fetchone()[0],
-            "dbsize": os.path.getsize(server_conf["database"])
-        }
-        return jsonify(result)
+                    yield val_list
 
+                data = {}
 
-@app.route('/admin/keys', methods=['GET'])
-@requires_auth
-def get_keys():
-    logging.getLogger(__name__).debug("keys")
-    return jsonify({"keys": sorted([x[0] for x in keywords])})
+            elif x[0] not in keywords_dbkeys:
+                warnings.append("unknown key in file (%s): %s" % (f, x))
+            else:
+                data[x[0]] = x[1]
 
 
-@app.route('/admin/log', methods=['GET'])
-@requires_auth
-def get_log():
-    logging.getLogger(__name__).debug("log")
+def parse_data_file(f, enc):
+    warnings = []
+    songs = list(read_songs(f, enc, warnings))
+    return songs, warnings
 
-    def generate():
-        with open(server_conf["logfile"], "r") as f:
-            for line in f:
-                yield line
 
-    return Response(generate(), mimetype='text/plain')
+def parse_data_files(files, enc, workers):
+    if workers <= 1:
+        for f in files:
+            warnings = []
+            yield f, (read_songs(f, enc, warnings), warnings)
+        return
 
+    executor = get_parse_executor(workers)
+    pending = deque()
+    files = iter(files)
 
-@app.route("/")
-@requires_auth
-def get_index():
-    if data_error:
-        return get_log()
+    try:
+        while True:
+            # keep a bounded number of parsed files in flight
+            while len(pending) < workers * 2:
+                f = next(files, None)
 
-    logging.getLogger(__name__).debug("index")
-    return app.send_static_file("index.html")
+                if f is None:
+                    break
 
+                pending.append((f, executor.submit(parse_data_file, f, enc)))
 
-@app.errorhandler(NotFoundError)
-def not_found_error(error):
-    logging.getLogger(__name__).debug("Not found: %s", str(error))
-    return create_json_error_response(404, "Not found", str(error))
+            if len(pending) == 0:
+                break
 
+            f, future = pending.popleft()
+            yield f, future.result()
+    except BrokenProcessPool:
+        shutdown_parse_executor()
+        raise
+    finally:
+        for _, future in pending:
+            future.cancel()
 
-@app.errorhandler(ValidationError)
-def bad_request_error(error):
-    logging.getLogger(__name__).debug("Bad request: %s", str(error))
-    return create_json_error_response(400, "Bad request", str(error))
 
+def get_parse_executor(workers):
+    global parse_executor, parse_executor_workers
 
-@app.errorhandler(500)
-def internal_error(error):
-    logging.getLogger(__name__).error("Internal error: %s", str(error))
-    return create_json_error_response(500, "Internal server error", str(error))
+    with parse_executor_lock:
+        if parse_executor is None or parse_executor_workers != workers:
+            if parse_executor is not None:
+                parse_executor.shutdown(wait=False)
 
+            # the server is multithreaded, a forked child could inherit a lock held by another thread
+            # (e.g. the import lock taken by strptime) and hang, so the parsers are spawned once and reused
+            parse_executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            parse_executor_workers = workers
 
-def create_json_error_response(code, reason, description):
-    message = {
-        "status": code,
-        "reason": reason,
-        "description": description
-    }
-    response = jsonify(message)
-    response.status_code = code
-    return response
+        return parse_executor
 
 
-def start_development_server():
-    logging.getLogger(__name__).warning("starting development server (werkzeug)")
-    app.run(host=server_conf['host'], port=int(server_conf['port']), debug=False)
+def shutdown_parse_executor():
+    global parse_executor
 
+    with parse_executor_lock:
+        if parse_executor is not None:
+            parse_executor.shutdown(wait=False)
+            parse_executor = None
 
-def start_production_server():
-    logging.getLogger(__name__).info("starting production server (waitress)")
-    from waitress import serve
-    serve(app, host=server_conf["host"], port=int(server_conf["port"]))
 
+def scan_data_files(c, paths=None):
+    datadir = os.path.normpath(server_conf["datadir"])
 
-def detect_data_changes():
-    while True:
-        time.sleep(server_conf["scandelay"])
-        load_data()
+    if paths is None:
+        files = find_files(server_conf["datadir"], ("*.txt", "*.txt.gz"))
+    else:
+        files = find_path_files(paths, ("*.txt", "*.txt.gz"))
 
+    c.execute("select id, value, mtime from file_d")
+    current = {v: (i, m) for i, v, m in c}
+    scope = set(current.keys())
+    loaded = set()
+    changed = {}
 
-def init():
-    load_config()
+    if paths is not None:
+        # only files under the given paths can have been removed
+        relpaths = [os.path.relpath(os.path.normpath(p), datadir) for p in paths]
+        scope = {x for x in scope for p in relpaths
+                 if p == os.curdir or x == p or x.startswith(p + os.sep)}
+
+    for f in files:
+        fpath = os.path.relpath(os.path.normpath(f), datadir)
+
+        if fpath in loaded:
+            continue
+
+        fmtime = os.path.getmtime(f)
+        loaded.add(fpath)
+
+        if fpath in current and abs(fmtime - current[fpath][1]) <= sys.float_info.epsilon:  # equals fp
+            continue
+
+        changed[f] = (fpath, fmtime)
+
+    return current, scope - loaded, changed
+
+
+def load_data_internal(paths=None, database=None, facetdeltas=None):
+    warncount = 0
+    songcount = 0
+    batchsize = server_conf.get("loadbatchsize", 10000)
+    workers = server_conf.get("loadworkers", 1) or os.cpu_count() or 1
+    enc = server_conf["encoding"]
+    starttime = time.time()
+
+    if paths is None:
+        logging.getLogger(__name__).info("loading data: %s", server_conf["datadir"])
+    else:
+        logging.getLogger(__name__).info("loading data: %s", ", ".join(sorted(paths)))
+
+    with get_writer_dbconn(database) as conn:
+        c = conn.cursor()
+        current, removed_files, changed = scan_data_files(c, paths)
+        dimcache = DimensionCache(c) if len(changed) > 0 else None
+        facetdeltas = facetdeltas if facetdeltas is not None else {}
+        orphans = {k: set() for k in keywords_dbkeys}
+        fileids = []
+        fulltext = fulltext_enabled()
+        c.execute("select coalesce(max(id), 0) + 1 from song_f")
+        songid = c.fetchone()[0]
+        update_load_progress(files=0, total=len(changed), songs=0)
+
+        for f, (parsed, warnings) in parse_data_files(list(changed.keys()), enc, workers):
+            fpath, fmtime = changed[f]
+            logging.getLogger(__name__).info("loading file: %s, %s", f, enc)
+
+            with conn:
+                existing = {}
+                previous = []
+
+                if fpath in current:
+                    fileid = current[fpath][0]
+                    c.execute("update file_d set mtime = ? where id = ?", (fmtime, fileid))
+                    c.execute("select id, fingerprint, position from song_f where file_id = ? order by position, id",
+                              (fileid,))
+                    previous = c.fetchall()
+
+                    for sid, fingerprint, _ in previous:
+                        existing.setdefault(fingerprint, deque()).append(sid)
+                else:
+                    c.execute("insert into file_d (value, mtime) values (?, ?)", (fpath, fmtime))
+                    fileid = c.lastrowid
+
+                fileids.append(fileid)
+                songs = []
+                ftsrows = []
+                added = []
+                kept = set()
+                moved = []
+                occurrences = {}
+                anchor = None
+                offset = 0
+                filecount = songcount
+
+                def insert_song(val_list, fingerprint, position):
+                    nonlocal songid, songcount
+                    songs.append([songid] + [dimcache.lookup(k, v) for k, v in zip(keywords_dbkeys, val_list)]
+                                 + [fileid, fingerprint, position])
+
+                    if fulltext:
+                        ftsrows.append([songid] + fulltext_values(val_list))
+
+                    for k in facetdeltas:
+                        facetdeltas[k][val_list[keywords_dbkeys.index(k)]] += 1
+
+                    songid += 1
+                    songcount += 1
+
+                    if len(songs) >= batchsize:
+                        flush_songs(c, dimcache, songs, ftsrows)
+
+                records = iter(parsed)
+                position = 0
+
+                while True:
+                    # a batch at a time, so the songs of a file are never all in memory
+                    batch = list(islice(records, batchsize))
+
+                    if len(batch) == 0:
+                        break
+
+                    if len(existing) == 0:
+                        dimcache.prefetch(c, batch)
+
+                    for val_list in batch:
+                        fingerprint = song_fingerprint(val_list, occurrences)
+                        ids = existing.get(fingerprint)
+
+                        if ids:
+                            anchor = ids.popleft()
+                            offset = 0
+                            kept.add(anchor)
+                            moved.append((position, anchor))
+                        elif len(existing) > 0:
+                            # a changed song is placed by the last unchanged song before it
+                            added.append(((anchor, offset), position, val_list, fingerprint))
+                            offset += 1
+                        else:
+                            insert_song(val_list, fingerprint, position)
+
+                        position += 1
+
+                removed = {}
+                anchor = None
+                offset = 0
+
+                for sid, _, _ in previous:
+                    if sid in kept:
+                        anchor = sid
+                        offset = 0
+                    else:
+                        removed[(anchor, offset)] = sid
+                        offset += 1
+
+                unchanged = len(moved)
+                positions = {sid: position for sid, _, position in previous}
+                moved = [x for x in moved if positions[x[1]] != x[0]]
+                c.executemany("update song_f set position = ? where id = ?", moved)
+                subtract_facet_values(c, facetdeltas, sorted(removed.values()))
+                collect_song_dimension_ids(c, orphans, sorted(removed.values()))
+                updates = []
+                ftsupdates = []
+                dimcache.prefetch(c, [x[2] for x in added])
+
+                for slot, position, val_list, fingerprint in added:
+                    sid = removed.pop(slot, None)
+
+                    if sid is None:
+                        insert_song(val_list, fingerprint, position)
+                        continue
+
+                    # a changed song keeps the id of the song it replaced at the same place in the file,
+                    # any other song gets a new id so that an old id never shows a different song
+                    updates.append([dimcache.lookup(k, v) for k, v in zip(keywords_dbkeys, val_list)]
+                                   + [fileid, fingerprint, position, sid])
+
+                    if fulltext:
+                        ftsupdates.append(fulltext_values(val_list) + [sid])
+
+                    for k in facetdeltas:
+                        facetdeltas[k][val_list[keywords_dbkeys.index(k)]] += 1
+
+                    songcount += 1
+
+                updated = len(updates)
+
+                flush_songs(c, dimcache, songs, ftsrows, updates, ftsupdates)
+                delete_songs(c, sorted(removed.values()))
+                logging.getLogger(__name__).debug(
+                    "file %s: %d unchanged, %d moved, %d updated, %d inserted, %d deleted", fpath, unchanged,
+                    len(moved), updated, songcount - filecount - updated, len(removed))
+
+            for w in warnings:
+                logging.getLogger(__name__).warning(w)
+                warncount += 1
+
+            update_load_progress(files=load_progress["files"] + 1, songs=songcount)
+
+        for x in removed_files:
+            logging.getLogger(__name__).info("Removing from index: %s", x)
+            with conn:
+                c.execute("select id from song_f where file_id = ?", (current[x][0],))
+                songids = [y[0] for y in c.fetchall()]
+                subtract_facet_values(c, facetdeltas, songids)
+                collect_song_dimension_ids(c, orphans, songids)
+                delete_file_songs(c, current[x][0])
+                c.execute("delete from file_d where id = ?", (current[x][0],))
+
+        if any(len(x) > 0 for x in orphans.values()):
+            with conn:
+                delete_orphans(c, orphans, fileids)
+
+        c.execute("select count(*) from sqlite_master where name = 'sqlite_stat1'")
+        analyzed = c.fetchone()[0] > 0
+
+        if not analyzed or len(changed) > 0 or len(removed_files) > 0:
+            logging.getLogger(__name__).info("analyzing database")
+            c.execute("analyze")
+
+        c.execute("pragma optimize")
+        update_dimension_counts(c)
+        c.execute("select count(*) from song_f")
+        loadedcount = c.fetchone()[0]
+        elapsed = max(time.time() - starttime, sys.float_info.epsilon)
+        logging.getLogger(__name__).info(
+            "Indexing %d songs. Loaded %d songs (%.1f songs/s) with %d warnings",
+            loadedcount, songcount, songcount / elapsed, warncount)
+
+        if warncount > 0:
+            logging.getLogger(__name__).warning("songs loaded with %d warnings", warncount)
+
+        metrics.inc("songdb_load_files_total", value=len(changed) + len(removed_files))
+        metrics.inc("songdb_load_songs_total", value=songcount)
+        metrics.set("songdb_last_load_files", value=len(changed) + len(removed_files))
+        metrics.set("songdb_last_load_songs", value=songcount)
+        return len(changed) + len(removed_files)
+
+
+def collect_dimension_ids(c, dimids, where, values):
+    c.execute("select %s from song_f where %s" % (", ".join("%s_id" % k for k in keywords_dbkeys), where), values)
+
+    for row in c:
+        for k, dimid in zip(keywords_dbkeys, row):
+            dimids[k].add(dimid)
+
+
+def collect_song_dimension_ids(c, dimids, songids):
+    for i in range(0, len(songids), 500):
+        chunk = songids[i:i + 500]
+        collect_dimension_ids(c, dimids, "id in (%s)" % ", ".join(["?"] * len(chunk)), chunk)
+
+
+def delete_orphans(c, candidates, fileids):
+    orphans = 0
+    live = {k: set() for k in keywords_dbkeys}
+
+    # values of changed songs are most often still used by other songs of the same file
+    for i in range(0, len(fileids), 500):
+        chunk = fileids[i:i + 500]
+        collect_dimension_ids(c, live, "file_id in (%s)" % ", ".join(["?"] * len(chunk)), chunk)
+
+    candidates = {k: sorted(ids - live[k]) for k, ids in candidates.items() if len(ids - live[k]) > 0}
+    c.execute("select name from sqlite_master where type = 'index' and tbl_name = 'song_f'")
+    indexes = {x[0] for x in c}
+    scanned = [k for k in candidates if "song_f_%s_id_idx" % k not in indexes]
+    referenced = {}
+
+    # the rest is checked in a single scan of song_f, instead of one scan per attribute
+    if len(scanned) > 0:
+        c.execute("select %s from song_f" % ", ".join(
+            "group_concat(distinct %s_id) filter (where %s_id between %d and %d and %s_id in (%s))" % (
+                k, k, candidates[k][0], candidates[k][-1], k, ", ".join(str(int(x)) for x in candidates[k]))
+            for k in scanned))
+        referenced = {k: {int(x) for x in (v or "").split(",") if x != ""} for k, v in zip(scanned, c.fetchone())}
+
+    for k, ids in candidates.items():
+        if k in referenced:
+            ids = [x for x in ids if x not in referenced[k]]
+
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            sql = "delete from %s_d where id in (%s)" % (k, ", ".join(["?"] * len(chunk)))
+
+            if k not in referenced:
+                sql += " and not exists (select 1 from song_f where %s_id = %s_d.id)" % (k, k)
+
+            c.execute(sql, chunk)
+            orphans += c.rowcount
+
+    maintenance_stats["orphans"] += orphans
+    logging.getLogger(__name__).info("Removed %d orphan dimension values", orphans)
+    return orphans
+
+
+def run_maintenance():
+    logging.getLogger(__name__).info("running database maintenance")
+
+    with get_writer_dbconn() as conn:
+        c = conn.cursor()
+        c.execute("pragma page_size")
+        pagesize = c.fetchone()[0]
+        c.execute("pragma freelist_count")
+        reclaimed = c.fetchone()[0] * pagesize
+        c.execute("pragma auto_vacuum")
+
+        if c.fetchone()[0] != 2:
+            # only takes effect for an existing database after a full vacuum
+            logging.getLogger(__name__).info("enabling incremental vacuum, rebuilding database")
+            c.execute("pragma auto_vacuum = incremental")
+            c.execute("vacuum")
+        else:
+            c.execute("pragma incremental_vacuum").fetchall()
+
+        c.execute("pragma optimize")
+        c.execute("pragma wal_checkpoint(TRUNCATE)").fetchall()
+
+    maintenance_stats["lastrun"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    maintenance_stats["reclaimed"] = reclaimed
+    logging.getLogger(__name__).info("database maintenance done, reclaimed %d bytes, database size %d bytes",
+                                     reclaimed, get_dbsize())
+
+
+def in_maintenance_hours(hour, hours):
+    start, end = hours
+
+    # a window like [22, 4] wraps around midnight
+    if start > end:
+        return hour >= start or hour < end
+
+    return start <= hour < end
+
+
+def schedule_maintenance():
+    interval = server_conf.get("maintenanceinterval", 86400)
+    hours = server_conf.get("maintenancehours", [0, 24])
+    lastrun = time.time()
+
+    if len(hours) != 2 or hours[0] == hours[1] or not all(0 <= x <= 24 for x in hours):
+        logging.getLogger(__name__).error("invalid maintenancehours %s, maintenance disabled", hours)
+        return
+
+    while True:
+        time.sleep(60)
+        now = time.time()
+
+        if now - lastrun < interval or not in_maintenance_hours(datetime.now().hour, hours):
+            continue
+
+        try:
+            run_maintenance()
+        except Exception:
+            logging.getLogger(__name__).exception("Error running database maintenance")
+
+        lastrun = now
+
+
+def fetch_song(songid, fields=None):
+    songs = fetch_songs([songid], fields)
+    return songs[0] if len(songs) > 0 else None
+
+
+def fetch_songs(songids, fields=None):
+    if fields is None:
+        fields = keywords_dbkeys
+
+    for k in fields:
+        if k != "id" and k not in keywords_lookup:
+            raise ValidationError("unknown field: %s" % k)
+
+    # repeated fields would join the same dimension table twice
+    fields = ["id"] + [k for k in dict.fromkeys(fields) if k != "id"]
+    songs = {}
+
+    with get_dbconn() as conn:
+        c = conn.cursor()
+        starttime = time.time()
+
+        # stay well below the sqlite limit of bound variables
+        for i in range(0, len(songids), 500):
+            chunk = songids[i:i + 500]
+            sql = build_select(fields) + "\nwhere song_f.id in (%s)" % ", ".join(["?"] * len(chunk))
+            logging.getLogger(__name__).debug(sql)
+            logging.getLogger(__name__).debug(chunk)
+
+            for row in c.execute(sql, chunk):
+                songs[row[0]] = to_song(fields, row)
+
+        metrics.observe("songdb_sql_duration_seconds", (("query", "fetch_songs"),), time.time() - starttime)
+        metrics.inc("songdb_sql_rows_total", (("query", "fetch_songs"),), len(songs))
+
+    return [songs[x] for x in songids if x in songs]
+
+
+class ResultCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, result, size):
+        maxentries = server_conf.get("cacheentries", 256)
+        maxbytes = server_conf.get("cachebytes", 64 * 1024 * 1024)
+
+        if maxentries <= 0 or size > maxbytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+
+            if old is not None:
+                self.size -= old[2]
+
+            self.entries[key] = (generation, result, size)
+            self.size += size
+
+            while len(self.entries) > maxentries or self.size > maxbytes:
+                entry = self.entries.popitem(last=False)[1]
+                self.size -= entry[2]
+                self.evictions += 1
+
+    def info(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "generation": data_generation
+            }
+
+
+result_cache = ResultCache()
+
+
+def like_regex(pattern):
+    # sqlite like, case insensitive for ascii characters only
+    regex = "".join(".*" if x == "%" else "." if x == "_" else re.escape(x) for x in pattern)
+    return re.compile(regex, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+class ColumnarIndex(object):
+    def __init__(self, generation):
+        self.generation = generation
+        self.ids = None
+        self.columns = {}
+        self.dimids = {}
+        self.dimvalues = {}
+        self.matches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, c):
+        c.execute("select id from song_f order by id")
+        self.ids = np.fromiter((x[0] for x in c), dtype=np.int64)
+
+        for k in keywords_dbkeys:
+            c.execute("select %s_id from song_f order by id" % k)
+            self.columns[k] = np.fromiter((x[0] for x in c), dtype=np.int32, count=len(self.ids))
+            c.execute("select id, value from %s_d order by value" % k)
+            rows = c.fetchall()
+            self.dimids[k] = np.array([x[0] for x in rows], dtype=np.int32)
+
+            if keywords_lookup[k][6] == "integer":
+                self.dimvalues[k] = np.array([x[1] for x in rows], dtype=np.int64)
+            else:
+                self.dimvalues[k] = [x[1] for x in rows]
+
+    def match_dimension(self, k, conds):
+        values = self.dimvalues[k]
+        default = keywords_lookup[k][7]
+
+        if isinstance(values, list):
+            matches = [x != default for x in values]
+
+            for op, arg in conds:
+                if op == ":":
+                    regex = re.compile(re.escape(arg), re.IGNORECASE | re.ASCII)
+                else:
+                    regex = like_regex(arg)
+
+                negate = op == "~"
+                matches = [m and (regex.fullmatch(x) is None) == negate for m, x in zip(matches, values)]
+
+            return self.dimids[k][np.array(matches, dtype=bool)]
+
+        # integer values are sorted, so comparisons become ranges
+        matches = values != default
+
+        for op, arg in conds:
+            if op in ("=", ":"):
+                matches &= values == arg
+            elif op == "<":
+                matches &= values < arg
+            elif op == ">":
+                matches &= values > arg
+            elif op == "~":
+                matches &= values != arg
+            else:
+                return None
+
+        return self.dimids[k][matches]
+
+    def lookup_matches(self, k, conds):
+        # text matching runs once per distinct value, so it is kept for the next page or query
+        with self.lock:
+            matched = self.matches.get((k, conds))
+
+            if matched is not None:
+                self.matches.move_to_end((k, conds))
+                return matched
+
+        matched = self.match_dimension(k, conds)
+
+        if matched is not None:
+            with self.lock:
+                self.matches[(k, conds)] = matched
+
+                while len(self.matches) > 1024:
+                    self.matches.popitem(last=False)
+
+        return matched
+
+    def search(self, groups, lastid, limit):
+        condgroups = {}
+        others = []
+
+        for group in groups:
+            if len(group) == 1 and not group[0][3]:
+                k, op, value, _ = group[0]
+                condgroups.setdefault(k, []).append((op, filter_tokens[k][op][2](value)))
+            else:
+                others.append(group)
+
+        start = np.searchsorted(self.ids, lastid, side="right")
+        mask = np.ones(len(self.ids) - start, dtype=bool)
+
+        for k, conds in condgroups.items():
+            matched = self.lookup_matches(k, tuple(sorted(conds, key=str)))
+
+            if matched is None:
+                return None
+
+            mask &= np.isin(self.columns[k][start:], matched)
+
+        for group in others:
+            groupmask = np.zeros(len(mask), dtype=bool)
+
+            for k, op, value, negated in group:
+                matched = self.lookup_matches(k, ((op, filter_tokens[k][op][2](value)),))
+
+                if matched is None:
+                    return None
+
+                # negation includes songs without a value, like "not in" in sql
+                groupmask |= np.isin(self.columns[k][start:], matched, invert=negated)
+
+            mask &= groupmask
+
+        return self.ids[start:][np.flatnonzero(mask)[:limit]].tolist()
+
+
+def columnar_enabled():
+    return server_conf.get("searchengine", "sqlite") == "numpy" and np is not None
+
+
+def refresh_columnar_index():
+    global columnar_index
+
+    # the owner process does not serve searches
+    if not columnar_enabled() or process_role == "owner":
+        columnar_index = None
+        return
+
+    with columnar_lock:
+        generation = data_generation
+
+        if columnar_index is not None and columnar_index.generation == generation:
+            return
+
+        starttime = time.time()
+        index = ColumnarIndex(generation)
+
+        try:
+            with get_dbconn() as conn:
+                # one read transaction, so that all columns come from the same snapshot even while a load
+                # writes, otherwise they could be misaligned with the ids
+                conn.execute("begin")
+
+                try:
+                    index.load(conn.cursor())
+                finally:
+                    conn.rollback()
+        except Exception:
+            # searches keep using sqlite, the index is out of date
+            logging.getLogger(__name__).exception("Error building columnar index")
+            return
+
+        columnar_index = index
+        logging.getLogger(__name__).info("columnar index built in %.1fs: %d songs", time.time() - starttime,
+                                         len(index.ids))
+
+
+def parse_filter(afilter):
+    # lines are and:ed, "|" separates or:ed terms on a line and "!" negates a term
+    groups = set()
+
+    for line in [x.strip() for x in afilter.strip().split("\n")]:
+        if len(line) == 0:
+            continue
+
+        terms = set()
+
+        for f in re.split(r"\s*\|\s*(?=!?\s*@)", line):
+            term = parse_filter_term(f)
+
+            if term is not None:
+                terms.add(term)
+
+        if len(terms) > 0:
+            groups.add(tuple(sorted(terms, key=term_order)))
+
+    # groups sort by shape before values, so filters of the same shape share a compiled statement
+    return tuple(sorted(groups, key=lambda x: (filter_shape((x,)), [t[2] for t in x])))
+
+
+def parse_filter_term(f):
+    negated = f.startswith("!")
+
+    if negated:
+        f = f[1:].lstrip()
+
+    if not f.startswith("@"):
+        raise ValidationError("filter must start with @: %s" % f)
+
+    i = 1
+
+    while i < len(f) and f[i].isalpha():
+        i += 1
+
+    lookup = filter_tokens.get(f[1:i], {}).get(f[i:i + 1])
+
+    if lookup is None:
+        raise ValidationError("unknown filter: %s" % f[1:])
+
+    searchstr = f[i + 1:].strip()
+
+    if len(searchstr) == 0:
+        return None
+
+    try:
+        lookup[2](searchstr)
+    except ValueError:
+        raise ValidationError("invalid value: %s" % f[1:])
+
+    return f[1:i], f[i], searchstr, negated
+
+
+def term_order(term):
+    # terms of the same shape sort together, whatever their values
+    return term[0], term[1], term[3], term[2]
+
+
+def filter_shape(groups):
+    return tuple(tuple((k, op, negated) for k, op, _, negated in group) for group in groups)
+
+
+def format_filter(groups, values=True):
+    return "\n".join(" | ".join("%s@%s%s%s" % ("!" if negated else "", k, op, v if values else "")
+                                for k, op, v, negated in group) for group in groups)
+
+
+class CompiledFilter(object):
+    def __init__(self, shape):
+        self.shape = shape
+        self.where = None
+        # where each bound value comes from, a term of the filter or a constant
+        self.slots = []
+
+    def compile(self):
+        merged = {}
+        others = []
+
+        for i, group in enumerate(self.shape):
+            if len(group) == 1 and not group[0][2]:
+                merged.setdefault(group[0][0], []).append((i, group[0]))
+            else:
+                others.append((i, group))
+
+        if len(dimension_counts) == 0:
+            with get_dbconn() as conn:
+                update_dimension_counts(conn.cursor())
+
+        parts = []
+
+        # the more distinct values a dimension has, the fewer songs each of them is expected to match,
+        # so the most selective semi-joins are evaluated first
+        for k in sorted(merged.keys(), key=lambda x: dimension_counts.get(x, 0), reverse=True):
+            conds = []
+            condslots = []
+
+            for i, (_, op, _) in merged[k]:
+                lookup = filter_tokens[k][op]
+
+                if fulltext_enabled() and k in fulltext_keys and op in ("=", "~"):
+                    parts.append(self.fulltext_sql(k, op))
+                    self.slots.append((i, 0, lookup[2]))
+                else:
+                    conds.append("value " + lookup[1] + " ?")
+                    condslots.append((i, 0, lookup[2]))
+
+            parts.append(self.dimension_sql(k, conds))
+            self.slots.extend(condslots)
+            self.slots.append((None, keywords_lookup[k][7], None))
+
+        for i, group in others:
+            terms = [self.term_sql(i, j, term) for j, term in enumerate(group)]
+            parts.append("(%s)" % " or ".join(terms) if len(terms) > 1 else terms[0])
+
+        self.where = " and ".join(parts)
+        return self
+
+    def fulltext_sql(self, k, op):
+        return "song_f.id %s (select rowid from song_fts where %s like ?)" % ("in" if op == "=" else "not in", k)
+
+    def dimension_sql(self, k, conds):
+        return "song_f.%s_id in (select id from %s_d where %s)" % (k, k, " and ".join(conds + ["value != ?"]))
+
+    def term_sql(self, i, j, term):
+        k, op, negated = term
+        lookup = filter_tokens[k][op]
+
+        if fulltext_enabled() and k in fulltext_keys and op in ("=", "~"):
+            sql = "%s and %s" % (self.fulltext_sql(k, op), self.dimension_sql(k, []))
+        else:
+            sql = self.dimension_sql(k, ["value " + lookup[1] + " ?"])
+
+        self.slots.append((i, j, lookup[2]))
+        self.slots.append((None, keywords_lookup[k][7], None))
+        return "not (%s)" % sql if negated else "(%s)" % sql
+
+    def bind(self, groups):
+        return [value if i is None else func(groups[i][value][2]) for i, value, func in self.slots]
+
+
+def compile_filter(groups):
+    shape = filter_shape(groups)
+    key = (shape, fulltext_enabled())
+
+    with compiled_filters_lock:
+        compiled = compiled_filters.get(key)
+
+        if compiled is not None:
+            compiled_filters.move_to_end(key)
+            return compiled
+
+    compiled = CompiledFilter(shape).compile()
+
+    with compiled_filters_lock:
+        compiled_filters[key] = compiled
+
+        while len(compiled_filters) > server_conf.get("statementcache", 256):
+            compiled_filters.popitem(last=False)
+
+    return compiled
+
+
+def encode_cursor(songid, count):
+    return base64.urlsafe_b64encode(("%d:%d" % (songid, count)).encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        songid, count = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii").split(":")
+        return int(songid), int(count)
+    except (ValueError, UnicodeError, AttributeError):
+        raise ValidationError("invalid cursor: %s" % cursor)
+
+
+def find_songs(afilter, limit=None, after=None, export=False):
+    criterias = parse_filter(afilter)
+
+    if len(criterias) == 0:
+        return [], None
+
+    lastid, count = decode_cursor(after) if after is not None else (0, 0)
+    pagesize = server_conf["maxresult"]
+
+    if limit is not None:
+        if not isinstance(limit, int) or limit <= 0:
+            raise ValidationError("limit must be a positive integer: %s" % limit)
+
+        pagesize = min(limit, pagesize)
+
+    if not export:
+        pagesize = min(pagesize, server_conf["maxresult"] - count)
+
+    if pagesize <= 0:
+        return [], None
+
+    key = (criterias, lastid, count, pagesize, export)
+    generation = data_generation
+    result = result_cache.get(key, generation)
+
+    if result is not None:
+        return result
+
+    # one extra row tells if there is a next page
+    songs = search_columnar(criterias, lastid, pagesize + 1, generation)
+
+    if songs is None:
+        songs = search_sqlite(criterias, lastid, pagesize + 1)
+
+    nextcursor = None
+
+    if len(songs) > pagesize:
+        songs = songs[:pagesize]
+
+        if export or count + pagesize < server_conf["maxresult"]:
+            nextcursor = encode_cursor(songs[-1]["id"], count + pagesize)
+
+    result = (songs, nextcursor)
+    result_cache.put(key, generation, result, sum(sum(len(str(v)) + 64 for v in x.values()) for x in songs))
+    return result
+
+
+def search_sqlite(criterias, lastid, limit):
+    where, values = build_where(criterias)
+    fields = search_fields
+    sql = build_select(fields, "(select * from song_f where %s and song_f.id > ? order by song_f.id limit ?) as song_f"
+                       % where) + "\norder by song_f.id"
+    values = values + [lastid, limit]
+    logging.getLogger(__name__).debug(sql)
+    logging.getLogger(__name__).debug(values)
+
+    with get_dbconn() as conn:
+        c = conn.cursor()
+        starttime = time.time()
+        songs = []
+
+        try:
+            with query_budget(conn, criterias):
+                for res in c.execute(sql, values):
+                    songs.append(to_song(fields, res))
+        except QueryCancelledError as e:
+            record_slow_query(conn, criterias, sql, values, None, time.time() - starttime, str(e))
+            raise
+
+        elapsed = time.time() - starttime
+        metrics.observe("songdb_sql_duration_seconds", (("query", "find_songs"),), elapsed)
+        metrics.inc("songdb_sql_rows_total", (("query", "find_songs"),), len(songs))
+
+        if 0 < server_conf.get("slowquerytime", 1) <= elapsed:
+            record_slow_query(conn, criterias, sql, values, len(songs), elapsed)
+
+    return songs
+
+
+def record_slow_query(conn, criterias, sql, values, rows, elapsed, cancelled=None):
+    try:
+        plan = {0: ""}
+        lines = []
+
+        # indent each step of the plan under its parent
+        for planid, parent, _, detail in conn.execute("explain query plan " + sql, values):
+            plan[planid] = plan.get(parent, "") + "  "
+            lines.append(plan[planid][2:] + detail)
+    except sqlite3.Error as e:
+        lines = ["unavailable: %s" % e]
+
+    shape = format_filter(criterias, False)
+    entry = {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "shape": shape,
+        "filter": format_filter(criterias),
+        "sql": sql,
+        "params": [type(x).__name__ for x in values],
+        "rows": rows,
+        "duration": elapsed,
+        "cancelled": cancelled,
+        "plan": lines
+    }
+    logging.getLogger(__name__).warning("slow query (%.2fs, %s rows): %s", elapsed, rows, shape.replace("\n", " "))
+
+    with slow_query_lock:
+        slow_queries.append(entry)
+
+        while len(slow_queries) > server_conf.get("slowqueries", 100):
+            slow_queries.popleft()
+
+        stats = slow_query_stats.get(shape)
+
+        if stats is None:
+            stats = {"shape": shape, "count": 0, "cancelled": 0, "total": 0.0, "max": 0.0, "rows": 0}
+            slow_query_stats[shape] = stats
+        else:
+            slow_query_stats.move_to_end(shape)
+
+        stats["count"] += 1
+        stats["cancelled"] += 1 if cancelled is not None else 0
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        stats["rows"] += rows or 0
+
+        # clients can make up any number of shapes, the least recently seen ones are dropped
+        while len(slow_query_stats) > server_conf.get("slowqueryshapes", 100):
+            slow_query_stats.popitem(last=False)
+
+
+@contextmanager
+def query_budget(conn, criterias):
+    timeout = server_conf.get("querytimeout", 0)
+    maxsteps = server_conf.get("querysteps", 0)
+
+    if timeout <= 0 and maxsteps <= 0:
+        yield
+        return
+
+    starttime = time.time()
+    budget = {"steps": 0, "reason": None}
+
+    def check_budget():
+        budget["steps"] += 1000
+
+        if maxsteps > 0 and budget["steps"] > maxsteps:
+            budget["reason"] = "steps"
+        elif timeout > 0 and time.time() - starttime > timeout:
+            budget["reason"] = "timeout"
+
+        # a non-zero return interrupts the query
+        return budget["reason"] is not None
+
+    conn.set_progress_handler(check_budget, 1000)
+
+    try:
+        yield
+    except sqlite3.OperationalError:
+        if budget["reason"] is None:
+            raise
+
+        cancelled_queries[budget["reason"]] += 1
+        metrics.inc("songdb_query_cancelled_total", (("reason", budget["reason"]),))
+        logging.getLogger(__name__).warning("query cancelled (%s) after %.1fs and %d steps: %s", budget["reason"],
+                                            time.time() - starttime, budget["steps"],
+                                            format_filter(criterias).replace("\n", " "))
+
+        if budget["reason"] == "steps":
+            raise QueryCancelledError("query exceeded the limit of %d steps" % maxsteps)
+
+        raise QueryCancelledError("query exceeded the time limit of %ss" % timeout)
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def search_columnar(criterias, lastid, limit, generation):
+    index = columnar_index
+
+    # the index is rebuilt after each load, until then searches go to sqlite
+    if index is None or index.generation != generation:
+        return None
+
+    starttime = time.time()
+    songids = index.search(criterias, lastid, limit)
+
+    if songids is None:
+        return None
+
+    metrics.observe("songdb_columnar_duration_seconds", (), time.time() - starttime)
+    return fetch_songs(songids, search_fields)
+
+
+def get_facet_keys():
+    return server_conf.get("facetkeys", ["genre", "codec", "samplerate", "bitdepth", "albumartist"])
+
+
+def refresh_facets(facetdeltas=None):
+    with facet_lock:
+        if facetdeltas is not None and len(facet_counts) > 0:
+            for k, delta in facetdeltas.items():
+                # adding counters drops values no longer used by any song
+                facet_counts[k] = facet_counts.get(k, Counter()) + delta
+            return
+
+        counts = {}
+
+        with get_dbconn() as conn:
+            c = conn.cursor()
+
+            for k in get_facet_keys():
+                c.execute("select %s_d.value, count(*) from song_f join %s_d on %s_d.id = song_f.%s_id "
+                          "group by song_f.%s_id" % (k, k, k, k, k))
+                counts[k] = Counter(dict(c.fetchall()))
+
+        facet_counts.clear()
+        facet_counts.update(counts)
+
+
+def find_facets(afilter, keys, limit):
+    criterias = parse_filter(afilter)
+    result = {}
+
+    if len(criterias) == 0:
+        if len(facet_counts) == 0:
+            refresh_facets()
+
+        for k in [x for x in keys if x in facet_counts]:
+            # the unset value can only be one of the top limit + 1
+            top = [(v, n) for v, n in facet_counts[k].most_common(limit + 1) if v != keywords_lookup[k][7]]
+            result[k] = [{"value": keywords_lookup[k][5](v), "count": n} for v, n in top[:limit]]
+
+        keys = [x for x in keys if x not in result]
+
+        if len(keys) == 0:
+            return result
+
+    key = ("facets", criterias, tuple(keys), limit)
+    generation = data_generation
+    cached = result_cache.get(key, generation)
+
+    if cached is not None:
+        result.update(cached)
+        return result
+
+    where, values = build_where(criterias) if len(criterias) > 0 else ("1", [])
+    facets = {}
+
+    with get_dbconn() as conn, query_budget(conn, criterias):
+        c = conn.cursor()
+        starttime = time.time()
+
+        for k in keys:
+            sql = ("select %s_d.value, count(*) from song_f join %s_d on %s_d.id = song_f.%s_id "
+                   "where %s and %s_d.value != ? group by song_f.%s_id order by count(*) desc limit ?"
+                   % (k, k, k, k, where, k, k))
+            logging.getLogger(__name__).debug(sql)
+            c.execute(sql, values + [keywords_lookup[k][7], limit])
+            facets[k] = [{"value": keywords_lookup[k][5](v), "count": n} for v, n in c]
+
+        metrics.observe("songdb_sql_duration_seconds", (("query", "find_facets"),), time.time() - starttime)
+        metrics.inc("songdb_sql_rows_total", (("query", "find_facets"),), sum(len(x) for x in facets.values()))
+
+    result_cache.put(key, generation, facets, sum(len(str(x["value"])) + 64 for v in facets.values() for x in v))
+    result.update(facets)
+    return result
+
+
+def build_suggestions(k):
+    with get_dbconn() as conn:
+        c = conn.cursor()
+        c.execute("select %s_d.value, count(*) from song_f join %s_d on %s_d.id = song_f.%s_id "
+                  "where %s_d.value != ? group by song_f.%s_id" % (k, k, k, k, k, k), (keywords_lookup[k][7],))
+        values = [(str(x).lower(), x, n) for x, n in ((keywords_lookup[k][5](v), n) for v, n in c)]
+
+    # values sorted by their lower case form, so a prefix is a range found by bisect
+    values.sort(key=lambda x: x[0])
+    return {
+        "keys": [x[0] for x in values],
+        "values": [x[1] for x in values],
+        "counts": [x[2] for x in values]
+    }
+
+
+def refresh_suggestions():
+    # only keys that have been asked for are kept up to date
+    for k in list(suggest_index.keys()):
+        get_suggestions_index(k)
+
+
+def get_suggestions_index(k):
+    index = suggest_index.get(k)
+    generation = data_generation
+
+    if index is not None and index["generation"] == generation:
+        return index
+
+    with suggest_lock:
+        index = suggest_index.get(k)
+
+        if index is None or index["generation"] != generation:
+            index = build_suggestions(k)
+            index["generation"] = generation
+            suggest_index[k] = index
+
+    return index
+
+
+def find_suggestions(k, prefix, limit):
+    index = get_suggestions_index(k)
+    prefix = prefix.lower()
+    keys = index["keys"]
+    lo = bisect.bisect_left(keys, prefix)
+    # every key starting with the prefix sorts before the prefix followed by the highest code point
+    hi = bisect.bisect_left(keys, prefix + chr(0x10FFFF), lo)
+    top = heapq.nlargest(limit, range(lo, hi), key=index["counts"].__getitem__)
+    return [{"value": index["values"][i], "count": index["counts"][i]} for i in top]
+
+
+def stream_songs(afilter, export=False):
+    criterias = parse_filter(afilter)
+
+    if len(criterias) == 0:
+        return iter([])
+
+    batchsize = server_conf.get("streambatchsize", 1000)
+    remaining = None if export else server_conf["maxresult"]
+
+    def generate():
+        nonlocal remaining
+        lastid = 0
+
+        # each batch is a keyset query of its own, so no connection or read transaction is held
+        # while a slow client reads the response
+        while remaining is None or remaining > 0:
+            limit = batchsize if remaining is None else min(batchsize, remaining)
+            songs = search_columnar(criterias, lastid, limit, data_generation)
+
+            if songs is None:
+                songs = search_sqlite(criterias, lastid, limit)
+
+            for song in songs:
+                yield song
+
+            if len(songs) < limit:
+                break
+
+            lastid = songs[-1]["id"]
+
+            if remaining is not None:
+                remaining -= len(songs)
+
+    songs = generate()
+    # the status can't change once the response has started, so a query cancelled before its first row
+    # is still answered with an error status
+    first = next(songs, None)
+    return iter([]) if first is None else chain([first], songs)
+
+
+def to_song(fields, row):
+    return {k: keywords_lookup[k][5](v) if k in keywords_lookup else v
+            for k, v in zip(fields, row) if k == "id" or v != keywords_lookup[k][7]}
+
+
+def build_select(fields, source="song_f"):
+    columns = ["song_f.id" if k == "id" else "%s_d.value" % k for k in fields]
+    # song_f drives the query, the planner must not scan small dimension tables as outer loops
+    joins = ["cross join %s_d on %s_d.id = song_f.%s_id" % (k, k, k) for k in fields if k != "id"]
+    return "select %s from %s\n%s" % (", ".join(columns), source, "\n".join(joins))
+
+
+def update_dimension_counts(c):
+    for k in keywords_dbkeys:
+        c.execute("select count(*) from %s_d" % k)
+        dimension_counts[k] = c.fetchone()[0]
+
+    # compiled filters order their semi-joins by these counts
+    with compiled_filters_lock:
+        compiled_filters.clear()
+
+
+def build_where(groups):
+    compiled = compile_filter(groups)
+    return compiled.where, compiled.bind(groups)
+
+
+@app.before_request
+def start_request_timer():
+    g.starttime = time.time()
+
+    if process_role == "worker":
+        sync_shared_state()
+
+
+@app.after_request
+def observe_request_time(response):
+    # streamed responses are timed until the first chunk
+    if "starttime" in g:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe("songdb_http_request_duration_seconds",
+                        (("route", route), ("method", request.method), ("status", response.status_code)),
+                        time.time() - g.starttime)
+
+    return response
+
+
+def valid_auth(username, password):
+    return username == server_conf["username"] and password == server_conf["password"]
+
+
+def requires_auth(f):
+    # basic auth
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+
+        if not server_conf["require_auth"]:
+            return f(*args, **kwargs)
+        elif not auth or not valid_auth(auth.username, auth.password):
+            return Response(
+                'Could not verify your access level for that URL.\n'
+                'You have to login with proper credentials', 401,
+                {'WWW-Authenticate': 'Basic realm="Login Required"'})
+        else:
+            return f(*args, **kwargs)
+
+    return decorated
+
+
+@app.route('/song', methods=['POST'])
+@requires_auth
+def do_search():
+    logging.getLogger(__name__).debug("search")
+    jsondata = request.get_json()
+
+    if "filter" not in jsondata:
+        raise ValidationError("filter is missing")
+
+    if jsondata["filter"] is None or jsondata["filter"].strip() == "":
+        return jsonify({"songs": [], "next": None})
+
+    logging.getLogger(__name__).debug(jsondata["filter"])
+
+    if request.args.get("stream") == "1" or request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        songs = stream_songs(jsondata["filter"], jsondata.get("export", False))
+
+        def generate():
+            try:
+                for song in songs:
+                    yield json.dumps(song, ensure_ascii=False) + "\n"
+            except QueryCancelledError as e:
+                # ends the stream with an error line, a client can tell it apart by the status member
+                yield json.dumps({"status": 503, "reason": "Service unavailable", "description": str(e)}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    songs, nextcursor = find_songs(jsondata["filter"], jsondata.get("limit"), jsondata.get("after"),
+                                   jsondata.get("export", False))
+    return jsonify({"songs": songs, "next": nextcursor})
+
+
+@app.route('/songs', methods=['POST'])
+@requires_auth
+def get_songs():
+    logging.getLogger(__name__).debug("get songs")
+    jsondata = request.get_json()
+
+    if "ids" not in jsondata:
+        raise ValidationError("ids is missing")
+
+    songids = jsondata["ids"]
+    fields = jsondata.get("fields")
+
+    if not isinstance(songids, list) or not all(isinstance(x, int) for x in songids):
+        raise ValidationError("ids must be a list of integers")
+
+    if len(songids) > server_conf["maxresult"]:
+        raise ValidationError("too many ids, maximum is %d" % server_conf["maxresult"])
+
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(x, str) for x in fields)):
+        raise ValidationError("fields must be a list of attributes")
+
+    return jsonify({"songs": fetch_songs(songids, fields)})
+
+
+@app.route('/song/facets', methods=['POST'])
+@requires_auth
+def get_facets():
+    logging.getLogger(__name__).debug("facets")
+    jsondata = request.get_json()
+    keys = jsondata.get("keys", get_facet_keys())
+    limit = jsondata.get("limit", 10)
+
+    if not isinstance(keys, list) or not all(x in keywords_lookup for x in keys):
+        raise ValidationError("keys must be a list of attributes")
+
+    if not isinstance(limit, int) or limit <= 0:
+        raise ValidationError("limit must be a positive integer: %s" % limit)
+
+    return jsonify({"facets": find_facets(jsondata.get("filter") or "", keys, limit)})
+
+
+@app.route('/suggest/<string:key>', methods=['GET'])
+@requires_auth
+def get_suggestions(key):
+    logging.getLogger(__name__).debug("suggest")
+
+    if key not in keywords_lookup:
+        raise ValidationError("unknown attribute: %s" % key)
+
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        raise ValidationError("limit must be a positive integer: %s" % request.args.get("limit"))
+
+    if limit <= 0:
+        raise ValidationError("limit must be a positive integer: %s" % limit)
+
+    prefix = request.args.get("prefix", "").strip()
+    return jsonify({"suggestions": find_suggestions(key, prefix, min(limit, 100))})
+
+
+@app.route('/song/<int:songid>', methods=['GET'])
+@requires_auth
+def get_song(songid):
+    logging.getLogger(__name__).debug("get song: %d", songid)
+    song = fetch_song(songid)
+
+    if song is None:
+        raise NotFoundError("song with id %d does not exist" % songid)
+
+    return jsonify(song)
+
+
+@app.route('/song/<int:songid>/<string:attribute>', methods=['GET'])
+@requires_auth
+def get_song_attr(songid, attribute):
+    logging.getLogger(__name__).debug("get song attribute: %d, %s", songid, attribute)
+
+    if attribute != "id" and attribute not in keywords_lookup:
+        raise NotFoundError("attribute %s not found on song: %d" % (attribute, songid))
+
+    song = fetch_song(songid, [attribute])
+
+    if song is None:
+        raise NotFoundError("song with id %d does not exist" % songid)
+
+    if attribute not in song:
+        raise NotFoundError("attribute %s not found on song: %d" % (attribute, songid))
+
+    return jsonify({attribute: song[attribute], "id": song["id"]})
+
+
+@app.route('/admin/info', methods=['GET'])
+@requires_auth
+def get_info():
+    logging.getLogger(__name__).debug("info")
+    with get_dbconn() as conn:
+        c = conn.cursor()
+        c.execute("select count(*) from v_song")
+        result = {
+            "loaded": c.fetchone()[0],
+            "dbsize": get_dbsize(),
+            "pool": dbpool.info(),
+            "cache": result_cache.info(),
+            "searchengine": "numpy" if columnar_index is not None else "sqlite",
+            "ready": data_ready.is_set(),
+            "cancelled": dict(cancelled_queries),
+            "progress": get_load_progress(),
+            "maintenance": maintenance_stats
+        }
+        return jsonify(result)
+
+
+@app.route('/admin/metrics', methods=['GET'])
+@requires_auth
+def get_metrics():
+    logging.getLogger(__name__).debug("metrics")
+    cache = result_cache.info()
+    extra = [
+        (("songdb_data_error", ()), 1 if data_error else 0),
+        (("songdb_data_generation", ()), data_generation),
+        (("songdb_cache_hits_total", ()), cache["hits"]),
+        (("songdb_cache_misses_total", ()), cache["misses"])
+    ]
+    return Response(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/admin/ready', methods=['GET'])
+def get_ready():
+    # no auth, load balancers poll this
+    if not data_ready.is_set():
+        return create_json_error_response(503, "Service unavailable", "initial load not finished")
+
+    return jsonify({"ready": True})
+
+
+def get_load_progress():
+    progress = dict(load_progress)
+
+    if not progress["running"]:
+        return {"running": False}
+
+    elapsed = max(time.time() - progress["started"], sys.float_info.epsilon)
+    progress["started"] = datetime.fromtimestamp(progress["started"]).strftime("%Y-%m-%d %H:%M:%S")
+    progress["elapsed"] = elapsed
+    progress["rate"] = progress["songs"] / elapsed
+    progress["eta"] = None
+
+    if progress["files"] > 0:
+        progress["eta"] = elapsed / progress["files"] * (progress["total"] - progress["files"])
+
+    return progress
+
+
+@app.route('/admin/slowqueries', methods=['GET'])
+@requires_auth
+def get_slow_queries():
+    logging.getLogger(__name__).debug("slowqueries")
+
+    with slow_query_lock:
+        queries = list(reversed(slow_queries))
+        shapes = [dict(x, mean=x["total"] / x["count"]) for x in slow_query_stats.values()]
+
+    return jsonify({
+        "threshold": server_conf.get("slowquerytime", 1),
+        "shapes": sorted(shapes, key=lambda x: x["total"], reverse=True),
+        "queries": queries
+    })
+
+
+@app.route('/admin/rebuild', methods=['POST'])
+@requires_auth
+def do_rebuild():
+    logging.getLogger(__name__).debug("rebuild")
+
+    if process_role == "worker":
+        # only the owner process writes to the database
+        rebuild_event.set()
+        response = jsonify({"status": "started"})
+        response.status_code = 202
+        return response
+
+    if not rebuild_lock.acquire(blocking=False):
+        return create_json_error_response(409, "Conflict", "database rebuild already running")
+
+    t = threading.Thread(target=rebuild_database, daemon=True)
+    t.start()
+    response = jsonify({"status": "started"})
+    response.status_code = 202
+    return response
+
+
+@app.route('/admin/keys', methods=['GET'])
+@requires_auth
+def get_keys():
+    logging.getLogger(__name__).debug("keys")
+    return jsonify({"keys": sorted([x[0] for x in keywords])})
+
+
+@app.route('/admin/log', methods=['GET'])
+@requires_auth
+def get_log():
+    logging.getLogger(__name__).debug("log")
+
+    def generate():
+        with open(server_conf["logfile"], "r") as f:
+            for line in f:
+                yield line
+
+    return Response(generate(), mimetype='text/plain')
+
+
+@app.route("/")
+@requires_auth
+def get_index():
+    if data_error:
+        return get_log()
+
+    logging.getLogger(__name__).debug("index")
+    return app.send_static_file("index.html")
+
+
+@app.errorhandler(NotFoundError)
+def not_found_error(error):
+    logging.getLogger(__name__).debug("Not found: %s", str(error))
+    return create_json_error_response(404, "Not found", str(error))
+
+
+@app.errorhandler(ValidationError)
+def bad_request_error(error):
+    logging.getLogger(__name__).debug("Bad request: %s", str(error))
+    return create_json_error_response(400, "Bad request", str(error))
+
+
+@app.errorhandler(QueryCancelledError)
+def query_cancelled_error(error):
+    return create_json_error_response(503, "Service unavailable", str(error))
+
+
+@app.errorhandler(500)
+def internal_error(error):
+    logging.getLogger(__name__).error("Internal error: %s", str(error))
+    return create_json_error_response(500, "Internal server error", str(error))
+
+
+def create_json_error_response(code, reason, description):
+    message = {
+        "status": code,
+        "reason": reason,
+        "description": description
+    }
+    response = jsonify(message)
+    response.status_code = code
+    return response
+
+
+def start_development_server():
+    logging.getLogger(__name__).warning("starting development server (werkzeug)")
+    app.run(host=server_conf['host'], port=int(server_conf['port']), debug=False)
+
+
+def start_production_server():
+    if process_role == "owner":
+        start_workers()
+        return
+
+    logging.getLogger(__name__).info("starting production server (waitress)")
+    from waitress import serve
+    serve(app, host=server_conf["host"], port=int(server_conf["port"]))
+
+
+def setup_workers():
+    global process_role, shared_state, rebuild_event
+
+    if server_conf.get("workers", 1) <= 1:
+        return
+
+    if server_conf["backend"].lower() != "waitress":
+        logging.getLogger(__name__).warning("workers require the waitress backend, running a single process")
+        return
+
+    # spawned workers import a fresh interpreter instead of inheriting the loader threads
+    ctx = multiprocessing.get_context("spawn")
+    process_role = "owner"
+    shared_state = ctx.Array("d", len(shared_fields))
+    rebuild_event = ctx.Event()
+
+
+def start_workers():
+    ctx = multiprocessing.get_context("spawn")
+    host, port = server_conf["host"], int(server_conf["port"])
+    family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+    sock = socket.create_server((host, port), family=family, backlog=1024)
+    args = (server_conf, sock, shared_state, rebuild_event, os.getpid())
+    processes = []
+
+    def start_worker():
+        p = ctx.Process(target=run_worker, args=args, daemon=True)
+        p.start()
+        return p
+
+    def handle_rebuilds():
+        while True:
+            rebuild_event.wait()
+            rebuild_event.clear()
+
+            if rebuild_lock.acquire(blocking=False):
+                rebuild_database()
+
+    threading.Thread(target=handle_rebuilds, daemon=True).start()
+    # make sure the workers are stopped with the owner
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.getLogger(__name__).info("starting %d workers (waitress) on %s:%d", server_conf["workers"], host, port)
+
+    try:
+        for _ in range(server_conf["workers"]):
+            processes.append(start_worker())
+
+        while True:
+            time.sleep(1)
+
+            for i, p in enumerate(processes):
+                if not p.is_alive():
+                    logging.getLogger(__name__).warning("worker %d exited with code %s, restarting", p.pid, p.exitcode)
+                    processes[i] = start_worker()
+    finally:
+        for p in processes:
+            p.terminate()
+
+        for p in processes:
+            p.join()
+
+
+def run_worker(conf, sock, state, event, ownerpid):
+    global server_conf, process_role, shared_state, rebuild_event
+
+    server_conf = conf
+    process_role = "worker"
+    shared_state = state
+    rebuild_event = event
+    configure_logging()
+    sync_shared_state()
+
+    if columnar_enabled():
+        threading.Thread(target=refresh_columnar_index, daemon=True).start()
+
+    def watch_owner():
+        while os.getppid() == ownerpid:
+            time.sleep(1)
+
+        os._exit(0)
+
+    threading.Thread(target=watch_owner, daemon=True).start()
+    logging.getLogger(__name__).info("worker started")
+    from waitress import serve
+    serve(app, sockets=[sock])
+
+
+class InotifyWatcher(object):
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    # attribute changes include a new mtime, e.g. touch
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.directory = directory
+        self.watches = {}
+        self.add_tree(directory)
+
+    def add_tree(self, directory):
+        for root, dirs, files in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.MASK)
+
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed: %s" % root)
+
+            self.watches[wd] = root
+
+    def read_events(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+
+        if len(ready) == 0:
+            return set()
+
+        buf = os.read(self.fd, 64 * 1024)
+        paths = set()
+        pos = 0
+
+        while pos < len(buf):
+            wd, mask, cookie, size = self.EVENT.unpack_from(buf, pos)
+            name = os.fsdecode(buf[pos + self.EVENT.size:pos + self.EVENT.size + size].rstrip(b"\0"))
+            pos += self.EVENT.size + size
+
+            if mask & self.IN_Q_OVERFLOW:
+                logging.getLogger(__name__).warning("inotify event queue overflow, rescanning: %s", self.directory)
+                paths.add(self.directory)
+                continue
+
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if wd not in self.watches:
+                continue
+
+            path = os.path.join(self.watches[wd], name) if len(name) > 0 else self.watches[wd]
+            paths.add(path)
+
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                try:
+                    self.add_tree(path)
+                except OSError:
+                    logging.getLogger(__name__).exception("could not watch directory: %s", path)
+
+        return paths
+
+
+def create_watcher():
+    if server_conf.get("watchmode", "poll") != "inotify":
+        return None
+
+    try:
+        return InotifyWatcher(server_conf["datadir"])
+    except (OSError, AttributeError, TypeError) as e:
+        logging.getLogger(__name__).warning("inotify not available, falling back to polling: %s", e)
+        return None
+
+
+def detect_data_changes(watcher=None, initial_load=False):
+    if initial_load:
+        load_data()
+
+    if watcher is None and server_conf["scandelay"] <= 0:
+        return
+
+    if watcher is not None:
+        logging.getLogger(__name__).info("watching for changes: %s", server_conf["datadir"])
+        delay = server_conf.get("watchdelay", 2)
+        scandelay = server_conf["scandelay"]
+        lastscan = time.time()
+
+        while True:
+            paths = watcher.read_events(max(0, lastscan + scandelay - time.time()) if scandelay > 0 else None)
+
+            if len(paths) == 0:
+                # inotify misses changes made elsewhere, e.g. on network file systems, so the whole
+                # directory is still reconciled every scandelay seconds
+                if scandelay > 0 and time.time() - lastscan >= scandelay:
+                    load_data()
+                    lastscan = time.time()
+
+                continue
+
+            # debounce, wait for the file system to go quiet before loading
+            while True:
+                more = watcher.read_events(delay)
+
+                if len(more) == 0:
+                    break
+
+                paths.update(more)
+
+            load_data(paths)
+
+    while True:
+        time.sleep(server_conf["scandelay"])
+        load_data()
+
+
+def init():
+    load_config()
     configure_logging()
+    setup_workers()
     setup_db()
-    load_data()
 
-    if server_conf["scandelay"] > 0:
-        t = threading.Thread(target=detect_data_changes, daemon=True)
+    if server_conf.get("searchengine", "sqlite") == "numpy" and np is None:
+        logging.getLogger(__name__).warning("numpy is not installed, searching with sqlite")
+
+    # start watching before the initial load so no change is missed
+    watcher = create_watcher()
+
+    if server_conf.get("warmstart", False):
+        # serve the existing database while the loader thread catches up
+        t = threading.Thread(target=detect_data_changes, args=(watcher, True), daemon=True)
+        t.start()
+    else:
+        load_data()
+
+        if watcher is not None or server_conf["scandelay"] > 0:
+            t = threading.Thread(target=detect_data_changes, args=(watcher,), daemon=True)
+            t.start()
+
+    if server_conf.get("maintenanceinterval", 86400) > 0:
+        t = threading.Thread(target=schedule_maintenance, daemon=True)
         t.start()
 
 
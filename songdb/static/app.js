@@ -95,8 +95,94 @@ function copyValue(tag, id, el) {
    $("#" + el).fadeOut(150).fadeIn(150);
 }
 
+function formatDuration(seconds) {
+   seconds = Math.ceil(seconds);
+
+   if (seconds < 60) {
+      return seconds + " s";
+   }
+
+   return Math.floor(seconds / 60) + " min " + (seconds % 60) + " s";
+}
+
+function showAppInfo() {
+   $.getJSON("/admin/info", function(json) {
+      var text = "(" + json.loaded + " songs, " + Math.ceil(json.dbsize / (1024 * 1024)) + " MB)";
+      $("#appinfo").text(text);
+
+      var progress = json.progress;
+
+      if (!progress.running) {
+         $("#loadinfo").text(json.ready ? "" : "[waiting for index]");
+         // keep polling until the first full load has finished
+         if (!json.ready) {
+            setTimeout(showAppInfo, 2000);
+         }
+         return;
+      }
+
+      var loadtext = "[indexing " + progress.files + "/" + progress.total + " files, " +
+                     Math.round(progress.rate) + " songs/s";
+
+      if (progress.eta !== null) {
+         loadtext += ", " + formatDuration(progress.eta) + " left";
+      }
+
+      $("#loadinfo").text(loadtext + "]");
+      setTimeout(showAppInfo, 2000);
+   });
+}
+
+function hideSuggestions() {
+   $("#suggest").empty().hide();
+}
+
+function currentSearchTag() {
+   var box = $("#searchbox")[0];
+   var text = box.value;
+   var pos = box.selectionStart;
+   var start = text.lastIndexOf("\n", pos - 1) + 1;
+   var end = text.indexOf("\n", pos);
+
+   if (end < 0) {
+      end = text.length;
+   }
+
+   // the term at the cursor may be one of several or:ed terms on the line
+   var bar = text.lastIndexOf("|", pos - 1);
+
+   if (bar >= start) {
+      start = bar + 1;
+   }
+
+   var next = text.indexOf("|", pos);
+
+   if (next >= 0 && next < end) {
+      end = next;
+   }
+
+   var match = /^(\s*!?\s*)@(\w+)([=:~])(.*?)(\s*)$/.exec(text.substring(start, end));
+
+   if (match === null) {
+      return null;
+   }
+
+   return {start: start, end: end, lead: match[1], key: match[2], op: match[3], prefix: match[4], trail: match[5]};
+}
+
+function useSuggestion(tag, value) {
+   var box = $("#searchbox");
+   var text = box.val();
+   var term = tag.lead + "@" + tag.key + tag.op + value;
+   box.val(text.substring(0, tag.start) + term + tag.trail + text.substring(tag.end));
+   box[0].selectionStart = box[0].selectionEnd = tag.start + term.length;
+   hideSuggestions();
+   box.focus();
+}
+
 function addSearchTag(tag, op, focus) {
    var box = $("#searchbox");
+   hideSuggestions();
 
    if (box.val().trim() === "") {
       box.val("@" + tag + op);
@@ -111,8 +197,15 @@ function addSearchTag(tag, op, focus) {
 
 $(function() {
 
-var resultset = [];
-var resultsetpos = 0;
+var pagesize = 100;
+var currentfilter = null;
+var nextcursor = null;
+var resultcount = 0;
+var searchtime = 0;
+var searchseq = 0;
+var loadingpage = false;
+var suggesttimer = null;
+var suggestseq = 0;
 
 $("#searchbox").val("");
 $("#searchbox").focus();
@@ -128,10 +221,7 @@ $.getJSON("/admin/keys", function(json) {
    registerSearchtagEvents();
 });
 
-$.getJSON("/admin/info", function(json) {
-    var text = "(" + json.loaded + " songs, " + Math.ceil(json.dbsize / (1024 * 1024)) + " MB)";
-    $("#appinfo").text(text);
-});
+showAppInfo();
 
 $("#clearbtn").click(function () {
     var box = $("#searchbox");
@@ -143,25 +233,37 @@ $("#searchbtn").click(function () {
     var box = $("#searchbox");
     var data = box.val();
     var json = {
-       filter: data
+       filter: data,
+       limit: pagesize
     };
 
     var start = performance.now();
+    var seq = ++searchseq;
+    loadingpage = true;
 
     postJSON("/song", json, function(response) {
-        var time = ((performance.now() - start) / 1000).toFixed(2);
-        $("#resultinfotext").text(response.songs.length + " result(s) in " + time + " seconds");
+        if (seq !== searchseq) {
+           return;
+        }
+        searchtime = ((performance.now() - start) / 1000).toFixed(2);
         var results = $("#result");
         results.empty();
-        resultset = response.songs;
-        resultsetpos = 0;
-        appendPartialResults(results);
+        currentfilter = data;
+        nextcursor = response.next;
+        resultcount = 0;
+        appendSongs(results, response.songs);
+        loadingpage = false;
         $('html,body').animate({scrollTop: $("#resultinfo").offset().top});
     }, function(err) {
+        if (seq !== searchseq) {
+           return;
+        }
         var msg = $.parseJSON(err.responseText).description;
         $("#resultinfotext").text(msg);
         var results = $("#result");
         results.empty();
+        nextcursor = null;
+        loadingpage = false;
     });
 });
 
@@ -174,19 +276,87 @@ $(window).scroll(function() {
 
 $("#searchbox").keyup(function (e) {
    if (e.ctrlKey && e.keyCode == 13) {
+      hideSuggestions();
       $("#searchbtn").trigger("click");
+   } else if (e.keyCode == 27) {
+      hideSuggestions();
    }
 });
 
-function appendPartialResults(container) {
-   var k = Math.min(resultsetpos + 100, resultset.length);
+$("#searchbox").on("input", function () {
+   // wait for a pause in typing, every keystroke would be a request
+   clearTimeout(suggesttimer);
+   suggesttimer = setTimeout(showSuggestions, 200);
+});
+
+function showSuggestions() {
+   var tag = currentSearchTag();
+   var seq = ++suggestseq;
+
+   if (tag === null || tag.prefix.trim() === "") {
+      hideSuggestions();
+      return;
+   }
+
+   $.getJSON("/suggest/" + tag.key, {prefix: tag.prefix, limit: 10}, function(json) {
+      if (seq !== suggestseq) {
+         return;
+      }
 
-   for(var i = resultsetpos; i < k; i++) {
-      var x = resultset[i];
+      var suggest = $("#suggest");
+      suggest.empty();
+
+      json.suggestions.forEach(function(x) {
+         var el = $("<a class='suggestion'></a>").text(x.value);
+         el.append($("<small></small>").text(" (" + x.count + ")"));
+         el.click(function () {
+            useSuggestion(tag, x.value);
+         });
+         suggest.append(el);
+      });
+
+      suggest.toggle(json.suggestions.length > 0);
+   }).fail(function() {
+      if (seq === suggestseq) {
+         hideSuggestions();
+      }
+   });
+}
+
+function appendSongs(container, songs) {
+   songs.forEach(function(x) {
       _.defaults(x, defaultsSongSmall);
       container.append("<div style='will-change:transform'>" + templateSongSmall(x) + "</div>");
+   });
+   resultcount += songs.length;
+   $("#resultinfotext").text(resultcount + (nextcursor !== null ? "+" : "") + " result(s) in " + searchtime + " seconds");
+}
+
+function appendPartialResults(container) {
+   if (loadingpage || nextcursor === null) {
+      return;
    }
-   resultsetpos=k;
+
+   var seq = searchseq;
+   var json = {
+      filter: currentfilter,
+      limit: pagesize,
+      after: nextcursor
+   };
+   loadingpage = true;
+
+   postJSON("/song", json, function(response) {
+      if (seq !== searchseq) {
+         return;
+      }
+      nextcursor = response.next;
+      appendSongs(container, response.songs);
+      loadingpage = false;
+   }, function(err) {
+      if (seq === searchseq) {
+         loadingpage = false;
+      }
+   });
 }
 
 function registerSearchtagEvents() {